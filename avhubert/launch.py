@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+import csv
+import json
 import logging
 import os
 from pathlib import Path
+import re
+import selectors
 import shlex
-import shutil
+import signal
+import socket
 import subprocess
 import sys
+import time
 import uuid
 
 
@@ -26,9 +32,24 @@ def get_parser():
     )
     parser.add_argument(
         "--max_num_log_files",
+        type=int,
         help="The maximum number of log-files to be kept",
         default=1000,
     )
+    parser.add_argument(
+        "--telemetry",
+        type=str,
+        default=None,
+        help="The path of file (.csv or .jsonl) to write updates/sec, wps and "
+        "loader stalls parsed from the JSON log of fairseq (log_format: json), "
+        "and CPU and RSS of processes run on this host",
+    )
+    parser.add_argument(
+        "--telemetry_interval",
+        type=float,
+        default=10.0,
+        help="Interval in seconds to sample CPU and RSS of processes",
+    )
     parser.add_argument(
         "--ngpu", type=int, default=1, help="The number of GPUs per node"
     )
@@ -63,6 +84,20 @@ def get_parser():
         help="Specify the address s of master. "
         "Master is a host machine has RANK0 process.",
     )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=0,
+        help="The maximum number of times to launch all ranks again when any "
+        "rank is failed. Training is resumed from checkpoint_last.pt in "
+        "hydra.run.dir, and a free port is chosen for master.",
+    )
+    parser.add_argument(
+        "--restart_interval",
+        type=float,
+        default=30.0,
+        help="Seconds to wait before restarting ranks",
+    )
     parser.add_argument("args", type=str, nargs="+")
     return parser
 
@@ -102,51 +137,445 @@ def get_commandline_args():
     return sys.executable + " " + " ".join(argv)
 
 
-def main(cmd=None):
-    logfmt = "%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s"
-    logging.basicConfig(level=logging.INFO, format=logfmt)
-    logging.info(get_commandline_args())
+class RankProcess:
+    # a process launched for ranks from rank on host (None for local).
+    # remote command writes its process group id into pgid_file.
+    def __init__(self, rank, process, host=None, pgid_file=None):
+        self.rank = rank
+        self.process = process
+        self.host = host
+        self.pgid_file = pgid_file
+        self.start = time.time()
+        self.end = None
 
-    parser = get_parser()
-    args = parser.parse_args(cmd)
+    def poll(self):
+        if self.end is None and self.process.poll() is not None:
+            self.end = time.time()
+        return self.process.returncode
 
-    rundir = Path("./exp").absolute() / Path(args.expname)
+    def failed(self):
+        return self.end is not None and self.process.returncode != 0
 
-    if args.log != "-":
-        logfile = rundir / Path(args.log)
-        # Log-rotation
-        for i in range(args.max_num_log_files - 1, -1, -1):
-            if i == 0:
-                p = logfile
-                pn = p.parent / (p.stem + ".1" + p.suffix)
+    def name(self):
+        return f"rank {self.rank}" + (f" on {self.host}" if self.host else "")
+
+    def signal(self, sig):
+        # signal all processes of the rank, including remote ones
+        if self.host is not None and self.pgid_file is not None:
+            # an unreachable host must not block stopping the other ranks
+            try:
+                subprocess.run(
+                    [
+                        "ssh",
+                        "-o",
+                        "ConnectTimeout=10",
+                        "-o",
+                        "BatchMode=yes",
+                        self.host,
+                        f"kill -{sig.name[3:]} -$(cat {self.pgid_file}) 2> /dev/null",
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=30,
+                )
+            except subprocess.TimeoutExpired:
+                logging.warning(
+                    f"Timed out sending {sig.name} to {self.name()} via SSH"
+                )
+        # children of the rank may be alive even after it exited
+        try:
+            os.killpg(self.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def rotate_logs(logfile, max_num_log_files):
+    # rename run.log to run.1.log, run.1.log to run.2.log, ... and remove the
+    # ones over max_num_log_files. per-rank logs, e.g. run.rank8.log, are
+    # rotated in the same way. the directory is listed only once.
+    if not logfile.parent.exists():
+        return
+    names = os.listdir(logfile.parent)
+    pattern = re.compile(
+        re.escape(logfile.stem)
+        + r"((?:\.rank\d+)?)(?:\.(\d+))?"
+        + re.escape(logfile.suffix)
+    )
+    logs = []
+    for name in names:
+        m = pattern.fullmatch(name)
+        if m is not None:
+            logs.append((int(m.group(2) or 0), m.group(1), name))
+    for i, rank, name in sorted(logs, reverse=True):
+        p = logfile.parent / name
+        if i >= max_num_log_files - 1:
+            p.unlink()
+        else:
+            p.rename(p.parent / f"{logfile.stem}{rank}.{i + 1}{logfile.suffix}")
+
+
+class Telemetry:
+    # throughput of training parsed from JSON log lines of fairseq, and CPU and
+    # RSS of processes of local ranks read from /proc, written into path as a
+    # time series. the format is CSV if path ends with '.csv', else JSON lines.
+    FIELDS = [
+        "time",
+        "kind",
+        "rank",
+        "epoch",
+        "num_updates",
+        "ups",
+        "wps",
+        "wpb",
+        "bsz",
+        "train_wall",
+        "stall_sec",
+        "stall_ratio",
+        "cpu_percent",
+        "rss_mb",
+        "num_procs",
+    ]
+
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.writer = None
+        if path.suffix == ".csv":
+            self.writer = csv.DictWriter(self.file, self.FIELDS)
+            self.writer.writeheader()
+        self.start = time.time()
+        self.train = []
+        self.procs = []
+        self.last_wall = {}
+        self.stall_sec = 0.0
+        self.stall_wall = 0.0
+        self.last_sample = self.start
+        self.cpu_ticks = {}
+
+    def write(self, record):
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def feed(self, rank, line):
+        # e.g. '... | INFO | train_inner | {"epoch": 1, "update": 0.2, ...}'
+        tag, _, message = line.rpartition(" | ")
+        if not tag.endswith("| train_inner") or not message.startswith("{"):
+            return
+        try:
+            stats = json.loads(message)
+        except ValueError:
+            return
+
+        def number(key):
+            # values are formatted as strings by fairseq
+            try:
+                return float(stats[key])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        record = {
+            "time": round(time.time() - self.start, 3),
+            "kind": "train",
+            "rank": rank,
+            "epoch": stats.get("epoch"),
+            "num_updates": number("num_updates"),
+            "ups": number("ups"),
+            "wps": number("wps"),
+            "wpb": number("wpb"),
+            "bsz": number("bsz"),
+            "train_wall": number("train_wall"),
+        }
+        # 'wall' is the time since start and 'train_wall' is the time spent in
+        # train steps in the interval. the rest is mostly waiting for data
+        # loader, and validation or checkpointing at the end of epoch.
+        wall = number("wall")
+        last_wall = self.last_wall.get(rank)
+        if None not in [wall, last_wall, record["train_wall"]] and wall > last_wall:
+            stall = max(0.0, wall - last_wall - record["train_wall"])
+            record["stall_sec"] = round(stall, 3)
+            record["stall_ratio"] = round(stall / (wall - last_wall), 4)
+            self.stall_sec += stall
+            self.stall_wall += wall - last_wall
+        self.last_wall[rank] = wall
+        self.train.append(record)
+        self.write(record)
+
+    def sample(self, ranks):
+        # CPU usage since the last sample and RSS of all processes in the
+        # process groups of ranks run on this host, e.g. data loader workers
+        pgids = set(x.process.pid for x in ranks if x.host is None and x.end is None)
+        if len(pgids) == 0:
+            return
+        now = time.time()
+        cpu_ticks = {}
+        rss_pages = 0
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/stat", "r") as f:
+                    fields = f.read().rpartition(")")[2].split()
+            except OSError:
+                continue
+            # state ppid pgrp ... utime stime ... rss, see proc(5)
+            if int(fields[2]) in pgids:
+                cpu_ticks[pid] = int(fields[11]) + int(fields[12])
+                rss_pages += int(fields[21])
+        ticks = sum(
+            max(0, x - self.cpu_ticks.get(pid, 0)) for pid, x in cpu_ticks.items()
+        )
+        record = {
+            "time": round(now - self.start, 3),
+            "kind": "proc",
+            "cpu_percent": round(
+                100.0 * ticks / os.sysconf("SC_CLK_TCK") / (now - self.last_sample), 1
+            ),
+            "rss_mb": round(rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1),
+            "num_procs": len(cpu_ticks),
+        }
+        self.cpu_ticks = cpu_ticks
+        self.last_sample = now
+        self.procs.append(record)
+        self.write(record)
+
+    def restart(self):
+        # wall time of fairseq and processes start again
+        self.last_wall = {}
+        self.cpu_ticks = {}
+        self.last_sample = time.time()
+
+    def close(self):
+        self.file.close()
+
+    def summary(self):
+        def mean(records, key):
+            values = [x[key] for x in records if x.get(key) is not None]
+            return sum(values) / len(values) if len(values) > 0 else float("nan")
+
+        if len(self.train) > 0:
+            logging.info(
+                f"telemetry: {len(self.train)} intervals until update "
+                f"{self.train[-1]['num_updates'] or 0:.0f}, "
+                f"updates/sec {mean(self.train, 'ups'):.2f}, "
+                f"wps {mean(self.train, 'wps'):.0f}, "
+                f"bsz {mean(self.train, 'bsz'):.1f}, "
+                f"stall {self.stall_sec:.0f}s "
+                f"({self.stall_sec / max(self.stall_wall, 1e-9):.1%})"
+            )
+        else:
+            logging.info("telemetry: no JSON log lines of train_inner found")
+        if len(self.procs) > 0:
+            logging.info(
+                f"telemetry: CPU {mean(self.procs, 'cpu_percent'):.0f}% on average, "
+                f"max {max(x['cpu_percent'] for x in self.procs):.0f}%, "
+                f"RSS max {max(x['rss_mb'] for x in self.procs):.0f}MB, "
+                f"processes max {max(x['num_procs'] for x in self.procs)}"
+            )
+
+
+class RankLog:
+    # output of a rank read from pipe. each line is prefixed by rank and time,
+    # and written into both the log file of the rank and the merged log file.
+    # without path, lines are written into the merged log file as they are.
+    def __init__(self, rank, path, merged, telemetry=None):
+        self.rank = rank
+        # appended when ranks are restarted
+        self.file = None if path is None else open(path, "a", encoding="utf-8")
+        self.merged = merged
+        self.telemetry = telemetry
+        self.buf = b""
+
+    def write(self, data):
+        # data is None at the end of output
+        lines = (self.buf + (data or b"")).split(b"\n")
+        self.buf = lines.pop()
+        if data is None and len(self.buf) > 0:
+            # the last line without newline
+            lines.append(self.buf)
+            self.buf = b""
+        now = time.strftime("%H:%M:%S")
+        for line in lines:
+            text = line.decode("utf-8", "replace")
+            if self.telemetry is not None:
+                self.telemetry.feed(self.rank, text)
+            if self.file is not None:
+                text = f"[rank{self.rank} {now}] " + text
+                self.file.write(text + "\n")
+            self.merged.write(text + "\n")
+        self.merged.flush()
+        if self.file is not None:
+            self.file.flush()
+            if data is None:
+                self.file.close()
+
+
+class Supervisor:
+    # wait for processes of ranks, woken up by SIGCHLD as soon as any of them
+    # exits. if a rank fails, all the other ranks are torn down immediately.
+    def __init__(self, grace_period=10.0):
+        self.grace_period = grace_period
+        self.ranks = []
+        self.timers = []
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        for sock in [self.wakeup_r, self.wakeup_w]:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        # a handler must be set, so that the signal is written to wakeup fd
+        self.old_wakeup_fd = signal.set_wakeup_fd(self.wakeup_w.fileno())
+        self.old_handler = signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    def add(self, rank_process):
+        self.ranks.append(rank_process)
+
+    def add_reader(self, pipe, callback):
+        # data read from pipe is passed to callback, and None at EOF
+        os.set_blocking(pipe.fileno(), False)
+        self.selector.register(pipe, selectors.EVENT_READ, callback)
+
+    def read(self, key):
+        # returns False if no more data is available now
+        try:
+            data = os.read(key.fileobj.fileno(), 65536)
+        except BlockingIOError:
+            return False
+        if len(data) > 0:
+            key.data(data)
+            return True
+        self.selector.unregister(key.fileobj)
+        key.fileobj.close()
+        key.data(None)
+        return False
+
+    def add_timer(self, interval, callback):
+        # callback is called every interval seconds while waiting
+        self.timers.append([time.time() + interval, interval, callback])
+
+    def run_timers(self):
+        # returns seconds until the next timer, or None if there is no timer
+        for timer in self.timers:
+            if timer[0] <= time.time():
+                timer[2]()
+                timer[0] = time.time() + timer[1]
+        if len(self.timers) == 0:
+            return None
+        return max(0.0, min(x[0] for x in self.timers) - time.time())
+
+    def drain(self):
+        # read outputs left in pipes of exited ranks
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not self.wakeup_r:
+                while self.read(key):
+                    pass
+
+    def close(self):
+        signal.signal(signal.SIGCHLD, self.old_handler)
+        signal.set_wakeup_fd(self.old_wakeup_fd)
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def select(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            if key.fileobj is self.wakeup_r:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
             else:
-                _p = logfile
-                p = _p.parent / (_p.stem + f".{i}" + _p.suffix)
-                pn = _p.parent / (_p.stem + f".{i + 1}" + _p.suffix)
+                self.read(key)
+
+    def wait(self):
+        # returns the rank failed first, or None if all ranks succeeded
+        try:
+            while True:
+                for rank in self.ranks:
+                    rank.poll()
+                failed = [x for x in self.ranks if x.failed()]
+                if len(failed) > 0:
+                    first = min(failed, key=lambda x: x.end)
+                    logging.error(
+                        f"{first.name()} failed first with exit code "
+                        f"{first.process.returncode} after "
+                        f"{first.end - first.start:.1f}s. Stopping all ranks."
+                    )
+                    self.teardown()
+                    self.drain()
+                    return first
+                if all(x.end is not None for x in self.ranks):
+                    self.drain()
+                    return None
+                self.select(timeout=self.run_timers())
+        except BaseException:
+            # e.g. KeyboardInterrupt or SIGTERM to this process
+            logging.error("Interrupted. Stopping all ranks.")
+            self.teardown()
+            raise
+
+    def teardown(self):
+        # SIGTERM to process groups of all ranks, then SIGKILL to the ones
+        # still alive after grace period
+        for rank in self.ranks:
+            rank.signal(signal.SIGTERM)
+        deadline = time.time() + self.grace_period
+        while time.time() < deadline and any(x.poll() is None for x in self.ranks):
+            self.select(timeout=max(0.0, min(1.0, deadline - time.time())))
+        for rank in self.ranks:
+            if rank.poll() is None:
+                rank.signal(signal.SIGKILL)
+                rank.process.wait()
+                rank.poll()
+
+
+def sigterm_to_exit(signum, frame):
+    sys.exit(128 + signum)
+
+
+def get_free_port(host=None):
+    # a port not in use on host, chosen by the OS by binding to port 0
+    code = (
+        "import socket; s = socket.socket(); s.bind(('', 0)); "
+        "print(s.getsockname()[1])"
+    )
+    if host is None:
+        with socket.socket() as s:
+            s.bind(("", 0))
+            return s.getsockname()[1]
+    result = subprocess.run(
+        ["ssh", host, f'python3 -c "{code}"'],
+        stdout=subprocess.PIPE,
+        check=True,
+        timeout=60,
+        text=True,
+    )
+    return int(result.stdout.strip().split("\n")[-1])
+
+
+def parse_hosts(args):
+    # e.g. args.host = "host1:0:2,host2:0:1"
+    hosts = []
+    ids_list = []
+    for host in args.host.split(","):
+        # e.g host = "host1:0:2"
+        sps = host.split(":")
+        host = sps[0]
+        if len(sps) > 1:
+            ids = [int(x) for x in sps[1:]]
+        else:
+            ids = list(range(args.ngpu))
+        hosts.append(host)
+        ids_list.append(ids)
+    return hosts, ids_list
 
-            if p.exists():
-                if i == args.max_num_log_files - 1:
-                    p.unlink()
-                else:
-                    shutil.move(p, pn)
 
-    processes = []
+def launch_ranks(args, rundir, supervisor, f, logfile, telemetry, master_port):
+    # launch processes of all ranks and add them to supervisor. returns cmd
     # Submit command via SSH
     if args.host is not None:
-        hosts = []
-        ids_list = []
-        # e.g. args.host = "host1:0:2,host2:0:1"
-        for host in args.host.split(","):
-            # e.g host = "host1:0:2"
-            sps = host.split(":")
-            host = sps[0]
-            if len(sps) > 1:
-                ids = [int(x) for x in sps[1:]]
-            else:
-                ids = list(range(args.ngpu))
-            hosts.append(host)
-            ids_list.append(ids)
-
+        hosts, ids_list = parse_hosts(args)
         world_size = sum(max(len(x), 1) for x in ids_list)
         logging.info(f"{len(hosts)}nodes with world_size={world_size} via SSH")
 
@@ -155,55 +584,61 @@ def main(cmd=None):
         else:
             env = ""
 
-        if args.log != "-":
-            logfile.parent.mkdir(parents=True, exist_ok=True)
-            f = logfile.open("w", encoding="utf-8")
-        else:
-            # Output to stdout/stderr
-            f = None
+        # process group ids of remote commands, to stop them from here
+        pgid_dir = rundir / "pgid"
+        pgid_dir.mkdir(parents=True, exist_ok=True)
 
         rank = 0
         logging.info(f"env={env}")
         logging.info(f"hosts={hosts}, ids_list={ids_list}")
         for host, ids in zip(hosts, ids_list):
             cmd = args.args + [
-                f"distributed_training.distributed_init_method=tcp://{hosts[0]}:{args.master_port}",
+                f"distributed_training.distributed_init_method=tcp://{hosts[0]}:{master_port}",
                 f"distributed_training.distributed_rank={rank}",
                 f"distributed_training.distributed_world_size={world_size}",
                 f"hydra.run.dir={str(rundir)}",
             ]
 
+            # the command runs in its own process group, whose id is saved
+            # in pgid_file. it is killed by 'kill -TERM -pgid' via another SSH.
+            pgid_file = pgid_dir / f"rank{rank}"
             heredoc = f"""<< EOF
 set -euo pipefail
 cd {os.getcwd()}
 {env}
-{" ".join([c if len(c) != 0 else "''" for c in cmd])}
+mkdir -p {pgid_dir}
+setsid {" ".join([c if len(c) != 0 else "''" for c in cmd])} &
+echo \\$! > {pgid_file}
+wait \\$!
 EOF
 """
 
             logging.info(" ".join(["ssh", host, "bash", heredoc]))
             print(" ".join(["ssh", host, "bash", heredoc]), file=f, flush=True)
-            # FIXME(kamo): The process will be alive
-            #  even if this program is stopped because we don't set -t here,
-            #  i.e. not assigning pty,
-            #  and the program is not killed when SSH connection is closed.
+            # The remote process is not killed when SSH connection is closed
+            # since we don't set -t here, i.e. not assigning pty. It is
+            # killed by its process group id when any rank is failed.
+            # The output is read via pipe and written into the log file of
+            # the rank, e.g. run.rank8.log, and into the merged run.log.
             process = subprocess.Popen(
                 ["ssh", host, "bash", heredoc],
-                stdout=f,
-                stderr=f,
+                stdout=f if f is None else subprocess.PIPE,
+                stderr=f if f is None else subprocess.STDOUT,
+                start_new_session=True,
             )
-
-            processes.append(process)
+            supervisor.add(RankProcess(rank, process, host, pgid_file))
+            if f is not None:
+                rank_log = logfile.with_name(
+                    f"{logfile.stem}.rank{rank}{logfile.suffix}"
+                )
+                print(f"rank{rank} on {host}: {rank_log}", file=f, flush=True)
+                supervisor.add_reader(
+                    process.stdout, RankLog(rank, rank_log, f, telemetry).write
+                )
 
             rank += len(ids)
     # --host is not specified: single node is used
     else:
-        if args.log != "-":
-            Path(logfile).parent.mkdir(parents=True, exist_ok=True)
-            f = logfile.open("w", encoding="utf-8")
-        else:
-            # Output to stdout/stderr
-            f = None
         world_size = args.ngpu
         # Using cmd as it is simply
         cmd = args.args + [
@@ -213,43 +648,124 @@ EOF
         ]
         logging.info(" ".join(cmd))
         print(" ".join(cmd), file=f, flush=True)
-        process = subprocess.Popen(cmd, stdout=f, stderr=f)
-        processes.append(process)
+        if telemetry is None:
+            process = subprocess.Popen(
+                cmd, stdout=f, stderr=f, start_new_session=True
+            )
+        else:
+            # the output is read via pipe to parse the JSON log
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            supervisor.add_reader(
+                process.stdout, RankLog(0, None, f or sys.stdout, telemetry).write
+            )
+        supervisor.add(RankProcess(0, process))
+    return cmd
+
+
+def main(cmd=None):
+    logfmt = "%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s"
+    logging.basicConfig(level=logging.INFO, format=logfmt)
+    logging.info(get_commandline_args())
+
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+
+    rundir = Path("./exp").absolute() / Path(args.expname)
 
     if args.log != "-":
-        logging.info(f"log file: {logfile}")
-
-    failed = False
-    while any(p.returncode is None for p in processes):
-        for process in processes:
-            # If any process is failed, try to kill the other processes too
-            if failed and process.returncode is not None:
-                process.kill()
-            else:
-                try:
-                    process.wait(0.5)
-                except subprocess.TimeoutExpired:
-                    pass
+        logfile = rundir / Path(args.log)
+        # Log-rotation
+        rotate_logs(logfile, args.max_num_log_files)
+        logfile.parent.mkdir(parents=True, exist_ok=True)
+        f = logfile.open("w", encoding="utf-8")
+    else:
+        logfile = None
+        # Output to stdout/stderr
+        f = None
+
+    signal.signal(signal.SIGTERM, sigterm_to_exit)
+    if args.telemetry is not None:
+        telemetry_file = rundir / Path(args.telemetry)
+        telemetry_file.parent.mkdir(parents=True, exist_ok=True)
+        rotate_logs(telemetry_file, args.max_num_log_files)
+        telemetry = Telemetry(telemetry_file)
+        logging.info(f"telemetry file: {telemetry_file}")
+    else:
+        telemetry = None
+
+    master_port = args.master_port
+    if args.host is not None and master_port is None:
+        master_port = get_free_port(parse_hosts(args)[0][0])
 
-                if process.returncode is not None and process.returncode != 0:
-                    failed = True
+    # If any process is failed, the other processes are killed too. Then all
+    # ranks are launched again with the same hydra.run.dir, so that fairseq
+    # resumes training from checkpoint_last.pt.
+    try:
+        for restart in range(args.max_restarts + 1):
+            if restart > 0:
+                # the port may be still in use by the processes killed
+                if args.host is not None:
+                    master_port = get_free_port(parse_hosts(args)[0][0])
+                message = (
+                    f"Restarting all ranks ({restart}/{args.max_restarts}) "
+                    f"in {args.restart_interval}s"
+                    + (f" with master port {master_port}" if args.host else "")
+                )
+                logging.warning(message)
+                print(message, file=f, flush=True)
+                time.sleep(args.restart_interval)
+                if telemetry is not None:
+                    telemetry.restart()
+
+            supervisor = Supervisor()
+            if telemetry is not None:
+                supervisor.add_timer(
+                    args.telemetry_interval,
+                    lambda: telemetry.sample(supervisor.ranks),
+                )
+            try:
+                cmd = launch_ranks(
+                    args, rundir, supervisor, f, logfile, telemetry, master_port
+                )
+                if args.log != "-":
+                    logging.info(f"log file: {logfile}")
+                failed = supervisor.wait()
+            finally:
+                supervisor.close()
 
-    for process in processes:
-        if process.returncode != 0:
+            if failed is None:
+                break
             print(
-                subprocess.CalledProcessError(returncode=process.returncode, cmd=cmd),
+                subprocess.CalledProcessError(
+                    returncode=failed.process.returncode, cmd=cmd
+                ),
                 file=sys.stderr,
             )
-            p = Path(logfile)
-            if p.exists():
-                with p.open() as f:
-                    lines = list(f)
-                raise RuntimeError(
-                    f"\n################### The last 1000 lines of {logfile} "
-                    f"###################\n" + "".join(lines[-1000:])
-                )
-            else:
-                raise RuntimeError
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+            telemetry.summary()
+
+    if failed is not None:
+        if args.log != "-" and failed.host is not None:
+            # the log of the failed rank rather than outputs of all ranks
+            logfile = logfile.with_name(
+                f"{logfile.stem}.rank{failed.rank}{logfile.suffix}"
+            )
+        if args.log != "-" and Path(logfile).exists():
+            with Path(logfile).open() as f:
+                lines = list(f)
+            raise RuntimeError(
+                f"\n################### The last 1000 lines of {logfile} "
+                f"###################\n" + "".join(lines[-1000:])
+            )
+        else:
+            raise RuntimeError(f"{failed.name()} failed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# Count frames of audio and video of utterances in file.list without decoding
+# them, and write nframes.audio and nframes.video into the work dir. This is
+# the same as running count_frames.py of avhubert for all shards.
+#
+#   python kmsav_count_frames.py --data-dir $WORKDIR --utt-info utt_info.txt
+#
+# The number of audio samples is read from the header of wav file, and the
+# number of video frames from the sample table of mp4 file. If they can not be
+# read, the numbers printed by crop_video.py (--utt-info) are used, and the
+# video is opened by OpenCV only if it is not found there either.
+# Counts are cached in nframes.cache by path, size and mtime of files, so
+# only new or changed files are read again.
+
+import argparse
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+# boxes containing the sample table of a track
+CONTAINER_BOXES = [b"moov", b"trak", b"mdia", b"minf", b"stbl"]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="count frames of audio and video for KMSAV dataset",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--data-dir", type=str, required=True, help="path to work dir storing file.list"
+    )
+    parser.add_argument(
+        "--video_ext", type=str, default="mp4", help="video file extension"
+    )
+    parser.add_argument(
+        "--utt-info",
+        type=str,
+        action="append",
+        default=[],
+        help="output of crop_video.py whose numbers of frames are used "
+        "if files can not be parsed",
+    )
+    parser.add_argument(
+        "--nj", type=int, default=16, help="the number of threads to read files"
+    )
+    return parser
+
+
+def wav_num_samples(path):
+    # the number of samples per channel from RIFF header, or None
+    with open(path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            return None
+        block_align = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                block_align = struct.unpack("<HHIIHH", f.read(16))[4]
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if not block_align:
+                    return None
+                # size may be invalid if wav was written to pipe
+                size = min(chunk_size, os.fstat(f.fileno()).st_size - f.tell())
+                return size // block_align
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def iter_boxes(f, end):
+    # yield (type, offset of payload, end of box) of mp4 boxes until end
+    pos = f.tell()
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def find_video_sample_count(f, start, end, handler=None):
+    # search boxes from start to end for 'stsz' of video track.
+    # 'hdlr' comes before 'minf' in 'mdia', so the handler type is known.
+    f.seek(start)
+    for box_type, payload, box_end in list(iter_boxes(f, end)):
+        if box_type == b"hdlr":
+            f.seek(payload + 8)
+            handler = f.read(4)
+        elif box_type == b"stsz" and handler == b"vide":
+            f.seek(payload + 8)
+            return struct.unpack(">I", f.read(4))[0]
+        elif box_type in CONTAINER_BOXES:
+            count = find_video_sample_count(
+                f, payload, box_end, None if box_type == b"trak" else handler
+            )
+            if count is not None:
+                return count
+    return None
+
+
+def mp4_num_frames(path):
+    # sample count of the first video track, or None
+    with open(path, "rb") as f:
+        return find_video_sample_count(f, 0, os.fstat(f.fileno()).st_size)
+
+
+def opencv_num_frames(path):
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return nframes
+
+
+def read_utt_info(paths):
+    # returns {'fileid:utt_index': (nframes_video, nframes_audio)}
+    counts = {}
+    for path in paths:
+        for line in open(path, "r", encoding="utf-8"):
+            w = line.rstrip("\n").split("\t")
+            if len(w) >= 5:
+                counts[w[0]] = (int(w[3]), int(w[4]))
+    return counts
+
+
+def utt_id(fid):
+    # e.g. 'zuSLzH7rPb0/utts/000003' -> 'zuSLzH7rPb0:000003'
+    return f"{fid.split('/')[0]}:{os.path.basename(fid)}"
+
+
+class FrameCounter:
+    # count frames of files, cached by path, size and mtime of each file
+    def __init__(self, cache_path, utt_info=None):
+        self.cache_path = cache_path
+        self.utt_info = utt_info or {}
+        self.cache = {}
+        if os.path.exists(cache_path):
+            for line in open(cache_path, "r", encoding="utf-8"):
+                path, size, mtime, nframes = line.rstrip("\n").rsplit("\t", 3)
+                self.cache[path] = (int(size), int(mtime), int(nframes))
+        self.hits = 0
+
+    def count(self, path, kind, fid):
+        st = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            self.hits += 1
+            return cached[2]
+
+        nframes = wav_num_samples(path) if kind == "audio" else mp4_num_frames(path)
+        if nframes is None and utt_id(fid) in self.utt_info:
+            nframes = self.utt_info[utt_id(fid)][0 if kind == "video" else 1]
+        if nframes is None:
+            if kind == "audio":
+                raise ValueError(f"cannot read the number of samples of {path}")
+            nframes = opencv_num_frames(path)
+        self.cache[path] = (st.st_size, st.st_mtime_ns, nframes)
+        return nframes
+
+    def save(self):
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for path, (size, mtime, nframes) in self.cache.items():
+                f.write(f"{path}\t{size}\t{mtime}\t{nframes}\n")
+        os.replace(tmp, self.cache_path)
+
+
+def count_frames(data_dir, utt_info=[], video_ext="mp4", nj=16):
+    # write nframes.audio and nframes.video of utterances in file.list
+    fids = [x.strip() for x in open(f"{data_dir}/file.list", "r", encoding="utf-8")]
+    counter = FrameCounter(f"{data_dir}/nframes.cache", read_utt_info(utt_info))
+
+    def count(fid):
+        return (
+            counter.count(f"{data_dir}/audio/{fid}.wav", "audio", fid),
+            counter.count(f"{data_dir}/video/{fid}.{video_ext}", "video", fid),
+        )
+
+    with ThreadPool(nj) as pool:
+        counts = pool.map(count, fids, chunksize=64)
+    counter.save()
+
+    with open(f"{data_dir}/nframes.audio", "w") as fa, open(
+        f"{data_dir}/nframes.video", "w"
+    ) as fv:
+        for nf_audio, nf_video in counts:
+            fa.write(f"{nf_audio}\n")
+            fv.write(f"{nf_video}\n")
+    print(f"{len(fids)} utterances counted, {counter.hits} files from cache")
+
+
+def main():
+    args = get_parser().parse_args()
+    count_frames(args.data_dir, args.utt_info, args.video_ext, args.nj)
+
+
+if __name__ == "__main__":
+    main()
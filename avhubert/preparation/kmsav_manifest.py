@@ -6,26 +6,196 @@
 
 import os
 import glob
+import hashlib
+import random
+from array import array
+import numpy as np
 import shutil
 import subprocess
 from tqdm import tqdm
 from pathlib import Path
 from gen_subword import gen_vocab
+from kmsav_count_frames import count_frames
 from tempfile import NamedTemporaryFile
+from itertools import zip_longest
 import argparse
 
+# index of '</s>' in fairseq dictionary
+EOS_ID = 2
+
+# a video listed in several splits belongs to the first one of them
+SPLITS = ["test", "valid", "train", "pretrain"]
+
 
 def get_split_info(info_file_path):
-    split_info = {"train": [], "test": [], "pretrain": [], "valid": []}
+    # returns {video id: split}. videos not listed are in pretrain split.
+    # e.g. line = "3bzOwIAsso4 issu 3 2708 pretrain license_error", where
+    # the 6th column is the status of videos failed to download. such videos
+    # are kept in their splits, since kmsav_prepare.py lists them if present.
+    split_info = {}
+    num_errors = 0
     for line in open(info_file_path, "r"):
-        line = line.strip()
-        if line[0] == "#":
-            continue
         w = line.split()
-        split_info[w[-1]].append(w[0])
+        if len(w) == 0 or w[0][0] == "#":
+            continue
+        if len(w) > 5:
+            num_errors += 1
+        if w[4] not in SPLITS:
+            raise ValueError(f"unknown split '{w[4]}' in {info_file_path}")
+        if w[0] not in split_info or SPLITS.index(w[4]) < SPLITS.index(
+            split_info[w[0]]
+        ):
+            split_info[w[0]] = w[4]
+    if num_errors > 0:
+        print(f"{num_errors} videos with error status in {info_file_path}")
     return split_info
 
 
+def iter_utts(file_list, label_list, nframes_audio_file, nframes_video_file):
+    # yield (fid, label, nf_audio, nf_video) reading lines of files together
+    with open(file_list, "r", encoding="utf-8") as ff, open(
+        label_list, "r", encoding="utf-8"
+    ) as fl, open(nframes_audio_file) as fa, open(nframes_video_file) as fv:
+        for lines in zip_longest(ff, fl, fa, fv):
+            if None in lines:
+                raise ValueError(
+                    f"{file_list}, {label_list}, {nframes_audio_file} and "
+                    f"{nframes_video_file} have different numbers of lines"
+                )
+            fid, label, nf_audio, nf_video = [x.strip() for x in lines]
+            yield fid, label.lower(), nf_audio, nf_video
+
+
+class SplitWriter:
+    # write utterances into {name}.tsv and {name}.wrd line by line.
+    # if sentencepiece model is given, token ids of labels followed by </s>
+    # are also written into {name}.wrd.ids.npy, and label i is
+    # ids[offsets[i]:offsets[i+1]] with offsets in {name}.wrd.offsets.npy.
+    # ids are same as the indices of fairseq dictionary of dict.wrd.txt,
+    # since it has the pieces except for <s>, <pad>, </s> and <unk> in order.
+    def __init__(self, target_dir, name, video_dir, audio_dir, video_ext, sp=None):
+        self.video_dir = os.path.abspath(video_dir)
+        self.audio_dir = os.path.abspath(audio_dir)
+        self.video_ext = video_ext
+        self.prefix = f"{target_dir}/{name}"
+        self.tsv = open(f"{target_dir}/{name}.tsv", "w")
+        self.wrd = open(f"{target_dir}/{name}.wrd", "w")
+        self.tsv.write("/\n")
+        self.sp = sp
+        self.ids = array("i")
+        self.offsets = array("q", [0])
+
+    def write(self, fid, label, nf_audio, nf_video):
+        self.tsv.write(
+            "\t".join(
+                [
+                    fid,
+                    f"{self.video_dir}/{fid}.{self.video_ext}",
+                    f"{self.audio_dir}/{fid}.wav",
+                    str(nf_video),
+                    str(nf_audio),
+                ]
+            )
+            + "\n"
+        )
+        self.wrd.write(f"{label}\n")
+        if self.sp is not None:
+            self.ids.extend(self.sp.encode(label))
+            self.ids.append(EOS_ID)
+            self.offsets.append(len(self.ids))
+
+    def close(self):
+        self.tsv.close()
+        self.wrd.close()
+        if self.sp is None:
+            return
+        dtype = np.uint16 if self.sp.get_piece_size() <= 65536 else np.int32
+        np.save(f"{self.prefix}.wrd.ids.npy", np.array(self.ids, dtype=dtype))
+        np.save(f"{self.prefix}.wrd.offsets.npy", np.array(self.offsets))
+        lengths = np.diff(self.offsets)
+        if len(lengths) > 0:
+            print(
+                f"{os.path.basename(self.prefix)}: {len(lengths)} labels, "
+                f"{len(self.ids)} tokens, tokens per label: "
+                f"mean {lengths.mean():.1f}, "
+                f"p95 {np.percentile(lengths, 95):.0f}, max {lengths.max()}"
+            )
+
+
+def bucket_boundaries(lengths, num_buckets):
+    # lengths splitting sorted lengths into buckets of about the same size
+    lengths = sorted(lengths)
+    return [lengths[len(lengths) * k // num_buckets] for k in range(1, num_buckets)]
+
+
+def bucket_index(length, boundaries):
+    for k, boundary in enumerate(boundaries):
+        if length < boundary:
+            return k
+    return len(boundaries)
+
+
+def train_spm(label_list, model_prefix, vocab_size, max_sentences=0, seed=0):
+    # train unigram model on lowercased labels, unless the model was trained
+    # on the same labels with the same parameters. with max_sentences, the
+    # model is trained on the sentences randomly sampled by seed.
+    hash_path = model_prefix.as_posix() + ".sha1"
+    h = hashlib.sha1(f"unigram {vocab_size} {max_sentences} {seed}\n".encode())
+    rng = random.Random(seed)
+    sample = []
+    with NamedTemporaryFile(mode="w", encoding="utf-8") as f:
+        for n, line in enumerate(open(label_list, "r", encoding="utf-8")):
+            line = line.strip().lower() + "\n"
+            h.update(line.encode("utf-8"))
+            if max_sentences <= 0:
+                f.write(line)
+            elif len(sample) < max_sentences:
+                sample.append(line)
+            else:
+                # reservoir sampling
+                k = rng.randint(0, n)
+                if k < max_sentences:
+                    sample[k] = line
+        f.writelines(sample)
+        f.flush()
+
+        digest = h.hexdigest()
+        if (
+            os.path.isfile(hash_path)
+            and open(hash_path).read().strip() == digest
+            and os.path.isfile(model_prefix.as_posix() + ".model")
+            and os.path.isfile(model_prefix.as_posix() + ".txt")
+        ):
+            print(f"Labels not changed, re-using {model_prefix}.model")
+            return
+        gen_vocab(Path(f.name), model_prefix, "unigram", vocab_size)
+    with open(hash_path, "w") as fo:
+        fo.write(digest + "\n")
+
+
+def write_histogram(path, split_lengths, num_buckets, fps=25):
+    # histogram of utterance durations per second of each split, and
+    # suggested bucket boundaries(video frames) of them
+    with open(path, "w") as fo:
+        for name, lengths in split_lengths.items():
+            if len(lengths) == 0:
+                continue
+            hist = {}
+            for length in lengths:
+                hist[length // fps] = hist.get(length // fps, 0) + 1
+            fo.write(
+                f"# {name}: {len(lengths)} utterances, "
+                f"{sum(lengths) / fps / 3600:.2f} hours\n"
+            )
+            for sec in range(max(hist) + 1):
+                count = hist.get(sec, 0)
+                bar = "*" * (count * 50 // len(lengths))
+                fo.write(f"{sec}-{sec + 1}s\t{count}\t{bar}\n")
+            boundaries = bucket_boundaries(lengths, num_buckets)
+            fo.write(f"# {name} bucket boundaries: {' '.join(map(str, boundaries))}\n")
+            print(f"{name} bucket boundaries(video frames): {boundaries}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="tsv preparation for KMSAV dataset",
@@ -46,6 +216,58 @@ def main():
     parser.add_argument(
         "--kmsav-list", type=str, required=True, help="path to kmsav list.txt"
     )
+    parser.add_argument(
+        "--spm-max-sentences",
+        type=int,
+        default=0,
+        help="train sentencepiece model on this number of randomly sampled "
+        "labels. 0 for all labels",
+    )
+    parser.add_argument(
+        "--spm-seed", type=int, default=0, help="random seed to sample labels"
+    )
+    parser.add_argument(
+        "--count-frames",
+        action="store_true",
+        help="write nframes.audio and nframes.video from headers of files "
+        "instead of running count_frames.py",
+    )
+    parser.add_argument(
+        "--utt-info",
+        type=str,
+        action="append",
+        default=[],
+        help="output of crop_video.py used by --count-frames",
+    )
+    parser.add_argument(
+        "--nj", type=int, default=16, help="the number of threads to count frames"
+    )
+    parser.add_argument(
+        "--sort-by-length",
+        action="store_true",
+        help="sort utterances of each split by the number of video frames",
+    )
+    parser.add_argument(
+        "--num-buckets",
+        type=int,
+        default=0,
+        help="also write utterances of each split into this number of "
+        "{split}.bucket{k}.tsv/.wrd by length, and length_hist.txt",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=int,
+        default=0,
+        help="skip utterances of train and pretrain splits longer than this "
+        "number of video frames, e.g. task.max_sample_size. 0 for no limit. "
+        "test and valid splits are kept whole",
+    )
+    parser.add_argument(
+        "--label-ids",
+        action="store_true",
+        help="also write token ids of labels into {split}.wrd.ids.npy and "
+        "{split}.wrd.offsets.npy",
+    )
     args = parser.parse_args()
 
     file_list, label_list = (
@@ -54,10 +276,14 @@ def main():
     )
     assert os.path.isfile(
         file_list
-    ), f"{file_list} not exist -> run kmsav_prepare.sh first"
+    ), f"{file_list} not exist -> run kmsav_prepare.py first"
     assert os.path.isfile(
         label_list
-    ), f"{label_list} not exist -> run kmsav_prepare.sh first"
+    ), f"{label_list} not exist -> run kmsav_prepare.py first"
+
+    if args.count_frames:
+        print("Counting frames of audio and video")
+        count_frames(args.data_dir, args.utt_info, args.video_ext, args.nj)
 
     nframes_audio_file, nframes_video_file = (
         f"{args.data_dir}/nframes.audio",
@@ -76,75 +302,100 @@ def main():
     # out_root = Path(vocab_dir).absolute()
     vocab_dir.mkdir(parents=True, exist_ok=True)
     spm_filename_prefix = f"spm_unigram{vocab_size}"
-    with NamedTemporaryFile(mode="w", encoding="utf-8") as f:
-        label_text = [
-            ln.strip() for ln in open(label_list, "r", encoding="utf-8").readlines()
-        ]
-        for t in label_text:
-            f.write(t.lower() + "\n")
-        gen_vocab(
-            Path(f.name), vocab_dir / spm_filename_prefix, "unigram", args.vocab_size
-        )
+    train_spm(
+        label_list,
+        vocab_dir / spm_filename_prefix,
+        args.vocab_size,
+        args.spm_max_sentences,
+        args.spm_seed,
+    )
     vocab_path = (vocab_dir / spm_filename_prefix).as_posix() + ".txt"
 
     audio_dir, video_dir = f"{args.data_dir}/audio", f"{args.data_dir}/video"
+    names = ["pretrain", "train", "valid", "test"]
+    split_info = get_split_info(args.kmsav_list)
 
-    def setup_target(target_dir, pretrain, train, valid, test):
-        for name, data in zip(
-            ["pretrain", "train", "valid", "test"], [pretrain, train, valid, test]
-        ):
-            with open(f"{target_dir}/{name}.tsv", "w") as fo:
-                fo.write("/\n")
-                for fid, _, nf_audio, nf_video in data:
-                    fo.write(
-                        "\t".join(
-                            [
-                                fid,
-                                os.path.abspath(f"{video_dir}/{fid}.{args.video_ext}"),
-                                os.path.abspath(f"{audio_dir}/{fid}.wav"),
-                                str(nf_video),
-                                str(nf_audio),
-                            ]
-                        )
-                        + "\n"
-                    )
-            with open(f"{target_dir}/{name}.wrd", "w") as fo:
-                for _, label, _, _ in data:
-                    fo.write(f"{label}\n")
-        shutil.copyfile(vocab_path, f"{target_dir}/dict.wrd.txt")
-        return
-
-    fids, labels = (
-        [x.strip() for x in open(file_list, "r", encoding="utf-8").readlines()],
-        [
-            x.strip().lower()
-            for x in open(label_list, "r", encoding="utf-8").readlines()
-        ],
-    )
-
-    nfs_audio, nfs_video = [x.strip() for x in open(nframes_audio_file).readlines()], [
-        x.strip() for x in open(nframes_video_file).readlines()
-    ]
-    # valid_fids = set([x.strip() for x in open(args.valid_ids).readlines()])
+    def split_of(fid):
+        return split_info.get(fid.split("/")[0], "pretrain")
 
-    split_info = get_split_info(args.kmsav_list)
+    def accepted(name, nf_video):
+        # only training data is limited, so that evaluation covers all of them
+        if name not in ["train", "pretrain"] or args.max_length <= 0:
+            return True
+        return int(nf_video) <= args.max_length
 
-    pretrain, train, valid, test = [], [], [], []
-    for fid, label, nf_audio, nf_video in zip(fids, labels, nfs_audio, nfs_video):
-        part = fid.split("/")[0]
-        # print(part)
-        if part in split_info["test"]:
-            test.append([fid, label, nf_audio, nf_video])
-        elif part in split_info["valid"]:
-            valid.append([fid, label, nf_audio, nf_video])
-        elif part in split_info["train"]:
-            train.append([fid, label, nf_audio, nf_video])
-        else:
-            pretrain.append([fid, label, nf_audio, nf_video])
     kmsav_preprocessed_dir = f"{args.out_dir}"
     print(f"Set up preprocessed kmsav data dir")
     os.makedirs(kmsav_preprocessed_dir, exist_ok=True)
-    setup_target(kmsav_preprocessed_dir, pretrain, train, valid, test)
+
+    # only lengths are read first to find boundaries of buckets
+    boundaries = {}
+    if args.num_buckets > 0:
+        split_lengths = {name: [] for name in names}
+        with open(file_list, "r", encoding="utf-8") as ff, open(
+            nframes_video_file
+        ) as fv:
+            for fid, nf_video in zip(ff, fv):
+                name = split_of(fid.strip())
+                if accepted(name, nf_video):
+                    split_lengths[name].append(int(nf_video))
+        write_histogram(
+            f"{kmsav_preprocessed_dir}/length_hist.txt", split_lengths, args.num_buckets
+        )
+        for name, lengths in split_lengths.items():
+            boundaries[name] = []
+            if len(lengths) > 0:
+                boundaries[name] = bucket_boundaries(lengths, args.num_buckets)
+
+    sp = None
+    if args.label_ids:
+        import sentencepiece
+
+        sp = sentencepiece.SentencePieceProcessor()
+        sp.load((vocab_dir / spm_filename_prefix).as_posix() + ".model")
+
+    # writers of each split followed by the ones of its buckets
+    writers = {}
+    for name in names:
+        writers[name] = [
+            SplitWriter(
+                kmsav_preprocessed_dir, x, video_dir, audio_dir, args.video_ext, sp
+            )
+            for x in [name] + [f"{name}.bucket{k}" for k in range(args.num_buckets)]
+        ]
+
+    def write(name, utt):
+        writers[name][0].write(*utt)
+        if args.num_buckets > 0:
+            writers[name][1 + bucket_index(int(utt[3]), boundaries[name])].write(*utt)
+
+    # utterances are written as they are read, unless they are sorted
+    sorted_utts = {name: [] for name in names}
+    dropped = {name: 0 for name in names}
+    for utt in iter_utts(file_list, label_list, nframes_audio_file, nframes_video_file):
+        name = split_of(utt[0])
+        if not accepted(name, utt[3]):
+            dropped[name] += 1
+            continue
+        if args.sort_by_length:
+            sorted_utts[name].append(utt)
+        else:
+            write(name, utt)
+    if args.max_length > 0:
+        for name in ["pretrain", "train"]:
+            print(
+                f"{name}: {dropped[name]} utterances longer than "
+                f"{args.max_length} video frames skipped"
+            )
+    for name, utts in sorted_utts.items():
+        utts.sort(key=lambda x: int(x[3]))
+        for utt in utts:
+            write(name, utt)
+
+    for name in names:
+        for writer in writers[name]:
+            writer.close()
+    shutil.copyfile(vocab_path, f"{kmsav_preprocessed_dir}/dict.wrd.txt")
     return
 
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Prepare file.list, label.list and audio dir of cropped KMSAV utterances for
+# avhubert preparation scripts.
+#
+#   python kmsav_prepare.py $CROP_DIR $KMSAV_LIST $WORKDIR
+#
+# file.list has paths of utterance videos relative to CROP_DIR without '.mp4',
+# sorted, of the videos listed in KMSAV_LIST. label.list has transcription of
+# each of them in a line. Utterance wav files are hard-linked (or reflinked)
+# into WORKDIR/audio, and copied only if CROP_DIR is on another filesystem.
+
+import argparse
+import errno
+import fcntl
+import os
+import re
+import shutil
+from multiprocessing.pool import ThreadPool
+
+# ioctl to share data blocks of files on btrfs, xfs, etc.
+FICLONE = 0x40049409
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="file.list, label.list and audio preparation for KMSAV dataset",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "crop_dir", type=str, help="path to the dir where cropped videos are saved"
+    )
+    parser.add_argument("list", type=str, help="path to kmsav/data/list.txt")
+    parser.add_argument(
+        "out_dir", type=str, help="dir to store file.list, label.list and audio"
+    )
+    parser.add_argument(
+        "--link",
+        choices=["hardlink", "reflink", "copy"],
+        default="hardlink",
+        help="how to put utterance wav files into out_dir/audio. "
+        "'hardlink' and 'reflink' fall back to copy across filesystems",
+    )
+    parser.add_argument(
+        "--nj", type=int, default=16, help="the number of threads to scan and link"
+    )
+    return parser
+
+
+def read_ids(list_path):
+    # video ids in the first column of list.txt
+    ids = set()
+    for line in open(list_path, "r"):
+        w = line.split()
+        if len(w) > 0 and w[0][0] != "#":
+            ids.add(w[0])
+    return ids
+
+
+def scan_video_dir(crop_dir, video_dir):
+    # returns utterances in a video dir, e.g. ['zuSLzH7rPb0/utts/000003', ...].
+    # '_audio.mp4' and unfinished '.part.mp4' files are not utterances.
+    fids = []
+    for root, _, files in os.walk(os.path.join(crop_dir, video_dir)):
+        rel = os.path.relpath(root, crop_dir)
+        for name in files:
+            if name.endswith(".mp4") and "_audio" not in name and ".part" not in name:
+                fids.append(os.path.join(rel, name[: -len(".mp4")]))
+    return fids
+
+
+def read_label(txt_path):
+    # same as `tr -s '\n' ' '`, i.e. newlines to spaces, runs of spaces squeezed
+    with open(txt_path, "r", encoding="utf-8") as f:
+        return re.sub(" +", " ", f.read().replace("\n", " "))
+
+
+def link_file(src, dst, method):
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        if method == "hardlink":
+            os.link(src, dst)
+            return
+        if method == "reflink":
+            with open(src, "rb") as fi, open(dst, "wb") as fo:
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+            return
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY]:
+            raise
+    shutil.copyfile(src, dst)
+
+
+def main():
+    args = get_parser().parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    ids = read_ids(args.list)
+    video_dirs = [x.name for x in os.scandir(args.crop_dir) if x.name in ids]
+
+    with ThreadPool(args.nj) as pool:
+        fids = sorted(
+            fid
+            for result in pool.starmap(
+                scan_video_dir, [(args.crop_dir, x) for x in video_dirs]
+            )
+            for fid in result
+        )
+        labels = pool.map(
+            read_label, [os.path.join(args.crop_dir, f"{x}.txt") for x in fids]
+        )
+        with open(os.path.join(args.out_dir, "file.list"), "w") as f:
+            f.writelines(f"{x}\n" for x in fids)
+        with open(os.path.join(args.out_dir, "label.list"), "w", encoding="utf-8") as f:
+            f.writelines(f"{x}\n" for x in labels)
+        print(f"{len(fids)} utterances of {len(video_dirs)} videos")
+
+        audio_dir = os.path.join(args.out_dir, "audio")
+        for d in sorted(set(os.path.dirname(x) for x in fids)):
+            os.makedirs(os.path.join(audio_dir, d), exist_ok=True)
+        pool.starmap(
+            link_file,
+            [
+                (
+                    os.path.join(args.crop_dir, f"{x}.wav"),
+                    os.path.join(audio_dir, f"{x}.wav"),
+                    args.link,
+                )
+                for x in fids
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
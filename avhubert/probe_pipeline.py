@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Measure throughput of the input pipeline of AV-HuBERT on CPU, before
+# training on GPUs. Utterances in {split}.tsv made by kmsav_manifest.py are
+# loaded in the same way as AVHubertDataset, i.e. video frames are decoded
+# into gray scale and center cropped, and log filterbank of audio is stacked
+# by stack_order_audio, by the given numbers of worker processes, e.g.
+#
+#   python probe_pipeline.py preparation/kmsav/train.tsv --workers 0 2 4 6 8
+#
+# samples/sec, bytes/sec read from files, frames/sec and latencies of loading
+# a sample are reported for each number of workers. Compare frames/sec with
+# the number of video frames consumed by training, i.e. dataset.max_tokens *
+# ngpu * updates/sec, to choose dataset.num_workers and the size of hosts.
+
+import argparse
+import json
+import logging
+import os
+import random
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+from python_speech_features import logfbank
+from scipy.io import wavfile
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="measure throughput of loading audio and video of manifests",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("tsv", type=str, nargs="+", help="{split}.tsv files")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4, 8],
+        help="numbers of worker processes to try. 0 loads in the main process",
+    )
+    parser.add_argument(
+        "--num-samples",
+        type=int,
+        default=1000,
+        help="the number of utterances sampled from tsv files",
+    )
+    parser.add_argument(
+        "--modalities",
+        type=str,
+        nargs="+",
+        choices=["audio", "video"],
+        default=["audio", "video"],
+        help="modalities to load",
+    )
+    parser.add_argument(
+        "--stack-order-audio",
+        type=int,
+        default=4,
+        help="the number of filterbank frames stacked into a frame",
+    )
+    parser.add_argument(
+        "--image-crop-size", type=int, default=88, help="size of cropped image"
+    )
+    parser.add_argument(
+        "--normalize",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="normalize audio features of each frame as task.normalize",
+    )
+    parser.add_argument(
+        "--warmup",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="read files once before measuring, so that all the numbers of "
+        "workers are measured with page cache in the same state",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--report", type=str, default=None, help="path to write results as JSON"
+    )
+    return parser
+
+
+def read_tsv(paths):
+    # returns [(video_path, audio_path), ...] of all utterances
+    utts = []
+    for path in paths:
+        with open(path, "r") as f:
+            root = f.readline().strip()
+            for line in f:
+                w = line.rstrip("\n").split("\t")
+                audio_path = w[2].split(":")[0]
+                utts.append((os.path.join(root, w[1]), os.path.join(root, audio_path)))
+    return utts
+
+
+def stacker(feats, stack_order):
+    # [T, F] -> [ceil(T / stack_order), F * stack_order], padded by zeros
+    feat_dim = feats.shape[1]
+    if len(feats) % stack_order != 0:
+        res = np.zeros([stack_order - len(feats) % stack_order, feat_dim])
+        feats = np.concatenate([feats, res.astype(feats.dtype)], axis=0)
+    return feats.reshape(-1, stack_order * feat_dim)
+
+
+def load_video(path, crop_size):
+    # gray scale frames, center cropped and normalized, [T, H, W, 1]
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    cap.release()
+    frames = np.stack(frames)
+    h, w = frames.shape[1:]
+    top, left = (h - crop_size) // 2, (w - crop_size) // 2
+    frames = frames[:, top : top + crop_size, left : left + crop_size]
+    # Normalize(0.0, 255.0) and Normalize(mean, std) of AVHubertDataset
+    frames = (frames.astype(np.float32) / 255.0 - 0.421) / 0.165
+    return np.expand_dims(frames, axis=-1)
+
+
+def load_audio(path, stack_order, normalize):
+    # stacked log filterbank, [T / stack_order, 26 * stack_order]
+    sample_rate, wav_data = wavfile.read(path)
+    feats = logfbank(wav_data, samplerate=sample_rate).astype(np.float32)
+    feats = stacker(feats, stack_order)
+    if normalize:
+        # same as F.layer_norm(feats, feats.shape[1:])
+        mean = feats.mean(axis=1, keepdims=True)
+        var = feats.var(axis=1, keepdims=True)
+        feats = (feats - mean) / np.sqrt(var + 1e-5)
+    return feats
+
+
+def load_sample(job):
+    # returns bytes read, the number of video frames and seconds of each step
+    (video_path, audio_path), args = job
+    nbytes, nframes, times = 0, 0, {}
+    start = time.perf_counter()
+    if "video" in args.modalities:
+        nframes = len(load_video(video_path, args.image_crop_size))
+        nbytes += os.path.getsize(video_path)
+        times["video"] = time.perf_counter() - start
+    if "audio" in args.modalities:
+        t = time.perf_counter()
+        feats = load_audio(audio_path, args.stack_order_audio, args.normalize)
+        nframes = nframes or len(feats)
+        nbytes += os.path.getsize(audio_path)
+        times["audio"] = time.perf_counter() - t
+    times["total"] = time.perf_counter() - start
+    return nbytes, nframes, times
+
+
+def warmup(utts):
+    # read files into page cache
+    for video_path, audio_path in utts:
+        for path in [video_path, audio_path]:
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    while f.read(1 << 20):
+                        pass
+
+
+def probe(utts, args, num_workers):
+    jobs = [(x, args) for x in utts]
+    if num_workers == 0:
+        start = time.perf_counter()
+        results = [load_sample(x) for x in jobs]
+        wall = time.perf_counter() - start
+    else:
+        # workers are started before measuring, as persistent workers
+        with Pool(num_workers) as pool:
+            pool.map(time.sleep, [0] * num_workers)
+            start = time.perf_counter()
+            results = list(pool.imap_unordered(load_sample, jobs))
+            wall = time.perf_counter() - start
+
+    result = {
+        "workers": num_workers,
+        "samples": len(results),
+        "wall_sec": wall,
+        "samples_per_sec": len(results) / wall,
+        "mb_per_sec": sum(x[0] for x in results) / wall / 2**20,
+        "frames_per_sec": sum(x[1] for x in results) / wall,
+    }
+    for step in ["total"] + args.modalities:
+        latency = np.array([x[2][step] for x in results]) * 1000
+        for p in [50, 95, 99]:
+            result[f"{step}_p{p}_ms"] = float(np.percentile(latency, p))
+    return result
+
+
+def main(cmd=None):
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+
+    utts = read_tsv(args.tsv)
+    if len(utts) > args.num_samples:
+        utts = random.Random(args.seed).sample(utts, args.num_samples)
+    logging.info(f"{len(utts)} utterances from {' '.join(args.tsv)}")
+    if args.warmup:
+        warmup(utts)
+
+    results = []
+    for num_workers in args.workers:
+        result = probe(utts, args, num_workers)
+        results.append(result)
+        logging.info(
+            f"workers={num_workers}: {result['samples_per_sec']:.1f} samples/s, "
+            f"p95 {result['total_p95_ms']:.0f}ms"
+        )
+
+    steps = ["total"] + args.modalities
+    print(
+        f"{'workers':>7} {'samples/s':>9} {'MB/s':>7} {'frames/s':>9} "
+        + " ".join(f"{s + ' p50/p95/p99(ms)':>26}" for s in steps)
+    )
+    for r in results:
+        print(
+            f"{r['workers']:>7} {r['samples_per_sec']:>9.1f} {r['mb_per_sec']:>7.1f} "
+            f"{r['frames_per_sec']:>9.0f} "
+            + " ".join(
+                f"{r[f'{s}_p50_ms']:>8.1f} {r[f'{s}_p95_ms']:>8.1f} "
+                f"{r[f'{s}_p99_ms']:>8.1f}"
+                for s in steps
+            )
+        )
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Parse ASD info files of a video into numpy arrays at once, and cache them
+# into a single npz file. The cache is re-used as long as the names and
+# modification times of ASD info files are not changed.
+#
+# ASD info file (e.g. kmsav_asd_v0.2/zuSLzH7rPb0/000003.txt) is as follows:
+#
+#   # Script: transcription of the utterance
+#   # ImageSize: 1920 1080
+#   # FPS: 25
+#   # Audio Duration(ms): 12345 15678
+#
+#   frame x y width height
+#   ...
+
+import glob
+import logging
+import os
+
+import numpy as np
+
+# increase this if the format of cache file is changed
+CACHE_VERSION = 1
+
+
+class AsdIndex:
+    # ASD info of all utterances of a video.
+    # boxes of utterance i are boxes[offsets[i]:offsets[i+1]],
+    # each row of which is (frame, x, y, width, height).
+    def __init__(
+        self, names, mtimes, scripts, image_size, fps, audio_ms, boxes, offsets
+    ):
+        self.names = names
+        self.mtimes = mtimes
+        self.scripts = scripts
+        self.image_size = image_size
+        self.fps = fps
+        self.audio_ms = audio_ms
+        self.boxes = boxes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.names)
+
+    def utt_index(self, i):
+        # e.g. '000003'
+        return os.path.splitext(self.names[i])[0]
+
+    def utt_boxes(self, i):
+        return self.boxes[self.offsets[i] : self.offsets[i + 1]]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp.npz"
+        np.savez(
+            tmp,
+            version=np.array(CACHE_VERSION),
+            names=self.names,
+            mtimes=self.mtimes,
+            scripts=self.scripts,
+            image_size=self.image_size,
+            fps=self.fps,
+            audio_ms=self.audio_ms,
+            boxes=self.boxes,
+            offsets=self.offsets,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            if int(f["version"]) != CACHE_VERSION:
+                return None
+            return cls(
+                f["names"],
+                f["mtimes"],
+                f["scripts"],
+                f["image_size"],
+                f["fps"],
+                f["audio_ms"],
+                f["boxes"],
+                f["offsets"],
+            )
+
+
+def parse_asd_txt(txt_path):
+    # returns header fields and boxes of an ASD info file
+    script, image_size, fps, audio_ms = "", (0, 0), None, None
+    lines = open(txt_path).readlines()
+
+    lineno = 0
+    while lines[lineno][0] == "#" or lines[lineno].strip() == "":
+        w = lines[lineno].split(":")
+        if w[0] == "# Script":
+            script = " ".join(w[1].split())
+        elif w[0] == "# ImageSize":
+            image_size = [int(x) for x in w[1].split()]
+        elif w[0] == "# FPS":
+            fps = int(w[1])
+        elif w[0] == "# Audio Duration(ms)":
+            audio_ms = [int(x) for x in w[1].split()]
+        lineno += 1
+
+    if fps is None or audio_ms is None:
+        raise ValueError(f"'# FPS' or '# Audio Duration(ms)' not in {txt_path}")
+
+    # face coordinates per frame, width & height data
+    boxes = np.array("".join(lines[lineno:]).split(), dtype=np.int32)
+    return script, image_size, fps, audio_ms, boxes.reshape(-1, 5)
+
+
+def build_asd_index(txt_dir, names, mtimes):
+    scripts, image_size, fps, audio_ms, boxes = [], [], [], [], []
+    for name in names:
+        fields = parse_asd_txt(os.path.join(txt_dir, name))
+        for values, x in zip([scripts, image_size, fps, audio_ms, boxes], fields):
+            values.append(x)
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in boxes])
+    return AsdIndex(
+        np.array(names),
+        np.array(mtimes, dtype=np.int64),
+        np.array(scripts),
+        np.array(image_size, dtype=np.int32).reshape(-1, 2),
+        np.array(fps, dtype=np.int32),
+        np.array(audio_ms, dtype=np.int32).reshape(-1, 2),
+        np.concatenate(boxes) if len(boxes) > 0 else np.zeros((0, 5), np.int32),
+        offsets,
+    )
+
+
+def load_asd_index(txt_dir, cache_path=None):
+    # returns AsdIndex of ASD info files in txt_dir, using cache_path if valid
+    txt_list = glob.glob(os.path.join(txt_dir, "??????.txt"))
+    txt_list.sort()
+    names = [os.path.basename(x) for x in txt_list]
+    mtimes = [os.stat(x).st_mtime_ns for x in txt_list]
+
+    if cache_path is not None and os.path.exists(cache_path):
+        index = AsdIndex.load(cache_path)
+        if (
+            index is not None
+            and index.names.tolist() == names
+            and index.mtimes.tolist() == mtimes
+        ):
+            return index
+        logging.info(f"{cache_path} is outdated. re-building it.")
+
+    index = build_asd_index(txt_dir, names, mtimes)
+    if cache_path is not None and len(index) > 0:
+        index.save(cache_path)
+    return index
+
+
+def adjust_av_index(fstart_a, fend_a, boxes):
+    # returns boxes for every frame from fstart_a to fend_a.
+    # frames before the first box or after the last box refer to
+    # the first or last box respectively.
+    frames = np.arange(fstart_a, fend_a + 1)
+    rows = np.searchsorted(boxes[:, 0], frames, side="right") - 1
+    adjusted = boxes[np.clip(rows, 0, len(boxes) - 1)]
+    adjusted[:, 0] = frames
+    return adjusted
+
+
+def crop_size(boxes):
+    # calculate the maximum length of the part to crop
+    return int(boxes[:, 3].max()), int(boxes[:, 4].max())
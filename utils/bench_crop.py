@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# Benchmark crop_video.py offline with synthetic videos and ASD info files.
+# A test pattern video is generated by ffmpeg, and ASD info files of
+# utterances are generated for each combination of the number of speakers and
+# the overlap ratio between consecutive utterances. Then crop_video.py is run
+# in a child process for each of given option sets, and its throughput, peak
+# RSS and bytes written are reported, e.g.
+#
+#   python3 utils/bench_crop.py --work-dir ./bench --duration 120 \
+#       --speakers 1 --speakers 4 --overlap 0 --overlap 0.5 \
+#       --run "--engine frames" --run "--engine stream" --run "--engine sparse"
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+)
+
+CROP_VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crop_video.py")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark crop_video.py with synthetic data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--work-dir", type=str, default="bench_crop", help="dir of generated data"
+    )
+    parser.add_argument("--width", type=int, default=1280, help="video width")
+    parser.add_argument("--height", type=int, default=720, help="video height")
+    parser.add_argument("--fps", type=int, default=25, help="video fps")
+    parser.add_argument("--duration", type=int, default=60, help="video duration(sec)")
+    parser.add_argument(
+        "--vcodec", type=str, default="libx264", help="codec of synthetic video"
+    )
+    parser.add_argument(
+        "--speakers",
+        type=int,
+        action="append",
+        default=None,
+        help="the number of speakers in a video, e.g. --speakers 1 --speakers 4 "
+        "(default: 1 and 4)",
+    )
+    parser.add_argument(
+        "--overlap",
+        type=float,
+        action="append",
+        default=None,
+        help="ratio of each utterance overlapping the previous one, "
+        "e.g. --overlap 0 --overlap 0.5 (default: 0 and 0.3)",
+    )
+    parser.add_argument(
+        "--utt-sec", type=float, default=4.0, help="mean length of utterances(sec)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--run",
+        type=str,
+        action="append",
+        default=None,
+        help="options of crop_video.py to benchmark, e.g. --run '--engine stream' "
+        "(default: each of --engine frames, stream and sparse)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="the number of runs per benchmark"
+    )
+    parser.add_argument(
+        "--report", type=str, default=None, help="write results into json file"
+    )
+    return parser
+
+
+def make_video(args, video_path):
+    # test pattern video with sine wave audio, and 16kHz mono wav of it
+    if not os.path.exists(video_path):
+        logging.info(f"generating {video_path}")
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"testsrc2=size={args.width}x{args.height}:rate={args.fps}",
+                "-f",
+                "lavfi",
+                "-i",
+                "sine=frequency=440:sample_rate=48000",
+                "-t",
+                str(args.duration),
+                "-c:v",
+                args.vcodec,
+                "-pix_fmt",
+                "yuv420p",
+                "-c:a",
+                "aac",
+                video_path,
+            ],
+            check=True,
+        )
+    audio_path = os.path.splitext(video_path)[0] + ".wav"
+    if not os.path.exists(audio_path):
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-i",
+                video_path,
+                "-ac",
+                "1",
+                "-vn",
+                "-ar",
+                "16000",
+                "-acodec",
+                "pcm_s16le",
+                audio_path,
+            ],
+            check=True,
+        )
+
+
+def make_utts(args, num_speakers, overlap, rng):
+    # returns [(speaker, start_ms, end_ms), ...] covering the whole video.
+    # each utterance starts when 'overlap' of it is left in the previous one.
+    utts = []
+    start = 500
+    end_ms = args.duration * 1000 - 500
+    while True:
+        length = int(args.utt_sec * 1000 * rng.uniform(0.5, 1.5))
+        if start + length > end_ms:
+            break
+        utts.append((len(utts) % num_speakers, start, start + length))
+        start += max(int(length * (1 - overlap)), 40)
+    return utts
+
+
+def write_asd_info(args, txt_dir, utts, num_speakers, rng):
+    # ASD info files in the same format as kmsav_asd, with a face of each
+    # speaker moving a little around its own position
+    os.makedirs(txt_dir, exist_ok=True)
+    face_w, face_h = args.width // 6, args.height // 4
+    cols = min(num_speakers, 4)
+    positions = []
+    for s in range(num_speakers):
+        x = (s % cols) * (args.width - face_w) // max(cols - 1, 1)
+        y = (s // cols) * face_h % (args.height - face_h)
+        positions.append((x, y))
+
+    num_frames = 0
+    for i, (speaker, start_ms, end_ms) in enumerate(utts, 1):
+        x, y = positions[speaker]
+        # ASD boxes usually start and end a few frames inside the audio
+        fstart = int(start_ms / 1000 * args.fps) + 1 + rng.randint(0, 3)
+        fend = int(end_ms / 1000 * args.fps) + 1 - rng.randint(0, 3)
+        lines = [
+            f"# Script: 합성 발화 {i}\n",
+            f"# ImageSize: {args.width} {args.height}\n",
+            f"# FPS: {args.fps}\n",
+            f"# Audio Duration(ms): {start_ms} {end_ms}\n",
+            "\n",
+        ]
+        for frame in range(fstart, fend + 1):
+            dx, dy = rng.randint(-8, 8), rng.randint(-8, 8)
+            w, h = face_w + rng.randint(-4, 4), face_h + rng.randint(-4, 4)
+            lines.append(f"{frame} {max(0, x + dx)} {max(0, y + dy)} {w} {h}\n")
+        with open(os.path.join(txt_dir, f"{i:06}.txt"), "w") as f:
+            f.writelines(lines)
+        # crop_video.py writes a frame per video frame of the audio range
+        num_frames += (
+            int(end_ms / 1000 * args.fps) - int(start_ms / 1000 * args.fps) + 1
+        )
+    return num_frames
+
+
+def make_dataset(args):
+    # returns [{fileid, video_path, speakers, overlap, utts, frames}, ...]
+    data_dir = os.path.join(args.work_dir, "data")
+    asd_dir = os.path.join(args.work_dir, "asd")
+    os.makedirs(data_dir, exist_ok=True)
+
+    base = f"base_{args.width}x{args.height}_{args.fps}fps_{args.duration}s"
+    base_path = os.path.join(data_dir, f"{base}.mp4")
+    make_video(args, base_path)
+
+    videos = []
+    for num_speakers in args.speakers:
+        for overlap in args.overlap:
+            # same seed per combination, so that the data are reproducible
+            rng = random.Random(f"{args.seed}-{num_speakers}-{overlap}")
+            fileid = f"{base}_s{num_speakers}_o{int(overlap * 100):02}"
+            video_path = os.path.join(data_dir, f"{fileid}.mp4")
+            for ext in [".mp4", ".wav"]:
+                link = os.path.join(data_dir, fileid + ext)
+                if not os.path.exists(link):
+                    os.symlink(os.path.basename(base) + ext, link)
+
+            txt_dir = os.path.join(asd_dir, fileid)
+            shutil.rmtree(txt_dir, ignore_errors=True)
+            utts = make_utts(args, num_speakers, overlap, rng)
+            frames = write_asd_info(args, txt_dir, utts, num_speakers, rng)
+            videos.append(
+                {
+                    "fileid": fileid,
+                    "video_path": video_path,
+                    "speakers": num_speakers,
+                    "overlap": overlap,
+                    "utts": len(utts),
+                    "frames": frames,
+                }
+            )
+    return asd_dir, videos
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_crop(asd_dir, save_root, options, video_path):
+    # run crop_video.py in a child process, and returns wall time,
+    # peak RSS(MB) of it and its children, and bytes written into save root
+    shutil.rmtree(save_root, ignore_errors=True)
+    cmd = [sys.executable, CROP_VIDEO, "--asdinfo-dir", asd_dir]
+    cmd += ["--save-root", save_root] + options.split() + [video_path]
+    start = time.time()
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    stderr = proc.stderr.read()
+    # wait4 gives resource usage of this child only, unlike getrusage
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+    if proc.returncode != 0:
+        logging.error(f"{' '.join(cmd)} failed:\n{stderr}")
+        sys.exit(-1)
+    return wall, rusage.ru_maxrss / 1024, dir_size(save_root)
+
+
+def main(cmd=None):
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+    if args.speakers is None:
+        args.speakers = [1, 4]
+    if args.overlap is None:
+        args.overlap = [0.0, 0.3]
+    if args.run is None:
+        args.run = ["--engine frames", "--engine stream", "--engine sparse"]
+
+    asd_dir, videos = make_dataset(args)
+
+    results = []
+    for n, options in enumerate(args.run):
+        save_root = os.path.join(args.work_dir, f"out{n}")
+        for video in videos:
+            for _ in range(args.repeat):
+                wall, rss_mb, nbytes = run_crop(
+                    asd_dir, save_root, options, video["video_path"]
+                )
+                result = dict(video, options=options)
+                result.update(
+                    wall_sec=wall,
+                    frames_per_sec=video["frames"] / wall,
+                    utts_per_sec=video["utts"] / wall,
+                    peak_rss_mb=rss_mb,
+                    written_mb=nbytes / 1024 / 1024,
+                )
+                results.append(result)
+                logging.info(
+                    f"[{options}] {video['fileid']}: {wall:.1f}s, "
+                    f"{result['frames_per_sec']:.1f} frames/s"
+                )
+        shutil.rmtree(save_root, ignore_errors=True)
+
+    print(
+        f"{'options':<30} {'spk':>3} {'ovl':>4} {'utts':>5} {'frames':>7} "
+        f"{'sec':>7} {'frames/s':>9} {'utts/s':>7} {'rss(MB)':>8} {'disk(MB)':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['options']:<30} {r['speakers']:>3} {r['overlap']:>4.2f} "
+            f"{r['utts']:>5} {r['frames']:>7} {r['wall_sec']:>7.1f} "
+            f"{r['frames_per_sec']:>9.1f} {r['utts_per_sec']:>7.2f} "
+            f"{r['peak_rss_mb']:>8.1f} {r['written_mb']:>9.1f}"
+        )
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
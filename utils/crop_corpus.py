@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Crop all videos listed in kmsav list.txt using a pool of processes.
+# Videos are scheduled longest-first according to 'len_in_sec' column, so
+# that a few long videos do not leave the other workers idle at the end.
+# Options not recognized here are passed to crop_video.py as they are, e.g.
+#
+#   python3 utils/crop_corpus.py --list data/list.txt \
+#       --video-dir /path/to/downloaded/data --nj 32 \
+#       --asdinfo-dir ./kmsav_asd_v0.2 --save-root ./cropped \
+#       --engine stream > utt_info.txt
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import crop_video
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Crop KMSAV video data listed in list.txt in parallel. "
+        "Unknown options are passed to crop_video.py.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--list", type=str, required=True, help="path to kmsav list.txt"
+    )
+    parser.add_argument(
+        "--video-dir", type=str, required=True, help="dir of downloaded videos"
+    )
+    parser.add_argument(
+        "--video-ext", type=str, default="mp4", help="video file extension"
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        action="append",
+        default=None,
+        help="split to process, e.g. --split train --split test. "
+        "all splits are processed if not given.",
+    )
+    parser.add_argument(
+        "--nj",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of processes to run simultaneously",
+    )
+    parser.add_argument(
+        "--profile-report",
+        type=str,
+        default=None,
+        help="run crop_video.py with --profile, and write profiles of all "
+        "videos aggregated into this json file",
+    )
+    return parser
+
+
+def read_video_list(list_path, splits=None):
+    # returns [(fileid, len_in_sec), ...] sorted by len_in_sec, longest first
+    # rows of videos not available have a status column, e.g. 'license_error'
+    videos = []
+    skipped = 0
+    for line in open(list_path, "r"):
+        w = line.split()
+        if len(w) == 0 or w[0][0] == "#":
+            continue
+        if len(w) > 5:
+            skipped += 1
+            continue
+        if splits is None or w[4] in splits:
+            videos.append((w[0], int(w[3])))
+    if skipped > 0:
+        logging.info(f"{skipped} videos with error status skipped in {list_path}")
+    videos.sort(key=lambda x: x[1], reverse=True)
+    return videos
+
+
+def format_time(sec):
+    sec = int(sec)
+    return f"{sec // 3600}:{sec // 60 % 60:02}:{sec % 60:02}"
+
+
+def crop_one(job):
+    # run crop_video.py in this process, and return its stdout and profile
+    fileid, video_path, crop_args = job
+    start = time.time()
+    out = io.StringIO()
+    error = None
+    report = None
+    try:
+        with contextlib.redirect_stdout(out):
+            report = crop_video.main(crop_args + [video_path])
+    except SystemExit as e:
+        # crop_video.py exits on missing inputs
+        error = f"exit with {e.code}"
+    except Exception as e:
+        logging.exception(f"ERROR while processing {video_path}")
+        error = repr(e)
+    return fileid, error, time.time() - start, out.getvalue(), report
+
+
+def main(cmd=None):
+    parser = get_parser()
+    args, crop_args = parser.parse_known_args(cmd)
+    if args.profile_report is not None:
+        crop_args = crop_args + ["--profile"]
+
+    videos = read_video_list(args.list, args.split)
+    len_in_sec = dict(videos)
+
+    jobs = []
+    total_sec = 0
+    for fileid, _ in videos:
+        video_path = os.path.join(args.video_dir, f"{fileid}.{args.video_ext}")
+        if not os.path.exists(video_path):
+            logging.warning(f"{video_path} not found. skipped.")
+            continue
+        jobs.append((fileid, video_path, crop_args))
+        total_sec += len_in_sec[fileid]
+
+    logging.info(
+        f"{len(jobs)} videos ({format_time(total_sec)}) with {args.nj} processes"
+    )
+
+    failed = []
+    reports = []
+    done_sec = 0
+    start = time.time()
+    with multiprocessing.Pool(args.nj) as pool:
+        for n, (fileid, error, elapsed, out, report) in enumerate(
+            pool.imap_unordered(crop_one, jobs), 1
+        ):
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            if error is not None:
+                failed.append(fileid)
+                logging.error(f"{fileid} failed: {error}")
+            if report is not None:
+                reports.append(report)
+
+            # ETA is estimated by the length of videos processed so far
+            done_sec += len_in_sec[fileid]
+            wall = time.time() - start
+            eta = wall / done_sec * (total_sec - done_sec) if done_sec > 0 else 0
+            logging.info(
+                f"[{n}/{len(jobs)}] {fileid} ({len_in_sec[fileid]}s) "
+                f"done in {elapsed:.1f}s, {done_sec / total_sec * 100:.1f}%, "
+                f"elapsed {format_time(wall)}, ETA {format_time(eta)}"
+            )
+
+    if args.profile_report is not None:
+        merged = crop_video.merge_profiles(reports)
+        with open(args.profile_report, "w") as f:
+            json.dump(merged, f, indent=2)
+        logging.info(f"profile of {len(reports)} videos: {args.profile_report}")
+        crop_video.log_profile(merged)
+
+    if len(failed) > 0:
+        logging.error(f"{len(failed)} videos failed: {' '.join(failed)}")
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
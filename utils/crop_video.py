@@ -1,10 +1,23 @@
 import os
 import glob
+import hashlib
 import argparse
+import json
+from collections import OrderedDict
+import queue
 import subprocess
+import struct
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import wave
 import cv2
 import logging
+import numpy as np
+
+from asd_index import adjust_av_index, crop_size, load_asd_index
 
 logging.basicConfig(
     level=logging.INFO,
@@ -12,6 +25,94 @@ logging.basicConfig(
 )
 
 
+class Stage:
+    # time, count and bytes of a stage measured in 'with' statement.
+    # count and nbytes can be updated inside of it.
+    def __init__(self, profiler, name, count, nbytes):
+        self.profiler = profiler
+        self.name = name
+        self.count = count
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(
+            self.name, time.perf_counter() - self.start, self.count, self.nbytes
+        )
+
+
+class NullStage:
+    # used when profiling is disabled
+    count = 0
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Profiler:
+    # accumulated time, count and bytes of each stage of cropping, i.e.
+    # extract, decode, asd, read, crop, encode, audio_cut, mux and finalize.
+    def __init__(self):
+        self.reset(False)
+
+    def reset(self, enabled):
+        self.enabled = enabled
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def stage(self, name, count=1, nbytes=0):
+        if not self.enabled:
+            return NullStage()
+        return Stage(self, name, count, nbytes)
+
+    def add(self, name, sec, count=1, nbytes=0):
+        with self.lock:
+            stat = self.stats.setdefault(name, {"sec": 0.0, "count": 0, "bytes": 0})
+            stat["sec"] += sec
+            stat["count"] += count
+            stat["bytes"] += nbytes
+
+    def report(self, **info):
+        return {
+            **info,
+            "wall_sec": time.perf_counter() - self.start,
+            "stages": self.stats,
+        }
+
+
+def merge_profiles(reports):
+    # aggregate profile reports of videos
+    merged = {"videos": len(reports), "wall_sec": 0.0, "stages": {}}
+    for report in reports:
+        merged["wall_sec"] += report["wall_sec"]
+        for name, stat in report["stages"].items():
+            total = merged["stages"].setdefault(
+                name, {"sec": 0.0, "count": 0, "bytes": 0}
+            )
+            for key in total:
+                total[key] += stat[key]
+    return merged
+
+
+def log_profile(report):
+    for name, stat in sorted(report["stages"].items(), key=lambda x: -x[1]["sec"]):
+        logging.info(
+            f"{name:>10}: {stat['sec']:9.2f}s {stat['count']:9} times "
+            f"{stat['bytes'] / 1024 / 1024:10.1f}MB"
+        )
+
+
+profiler = Profiler()
+
+
 def init_save_root(args):
     fileid = os.path.splitext(os.path.basename(args.video_path))[0]
     frames_dir = os.path.join(args.save_root, fileid, "frames")
@@ -20,7 +121,8 @@ def init_save_root(args):
     if not args.dry_run:
         os.makedirs(args.save_root, exist_ok=True)
         os.makedirs(utt_dir, exist_ok=True)
-        os.makedirs(frames_dir, exist_ok=True)
+        if args.engine == "frames":
+            os.makedirs(frames_dir, exist_ok=True)
 
     return frames_dir, utt_dir
 
@@ -38,56 +140,267 @@ def avi2images(video_path, frames_path, fps):
             f"ffmpeg -y -i {video_path} -qscale:v 2 -vf fps={fps}"
             f" -f image2 {output_path} -loglevel quiet",
         )
-        output = subprocess.check_call(command, shell=True, stdout=None)
+        with profiler.stage("extract"):
+            output = subprocess.check_call(command, shell=True, stdout=None)
     except subprocess.CalledProcessError as e:
         logging.error(f"ffmpeg failed with error message: {e.stderr}")
         sys.exit(-1)
 
 
-def adjust_av_index(fstart_a, fend_a, frame_list):
-    fstart_v = int(frame_list[0][0])
-    fend_v = int(frame_list[-1][0])
+def get_video_info(video_path):
+    # returns frame size and duration(sec) of video
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    nframes = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    src_fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    if width == 0 or height == 0:
+        logging.error(f"Cannot read frame size of '{video_path}'. Exit.")
+        sys.exit(-1)
+    duration = nframes / src_fps if src_fps > 0 else 0
+    return width, height, duration
 
-    header = []
-    footer = []
-    if fstart_a < fstart_v:
-        for frame in range(fstart_a, fstart_v):
-            header.append([frame, *frame_list[0][1:]])
-    else:
-        frame_list[: fstart_a - fstart_v] = []
 
-    if fend_a > fend_v:
-        for frame in range(fend_v + 1, fend_a + 1):
-            footer.append([frame, *frame_list[-1][1:]])
-    else:
-        frame_list[-(fend_v - fend_a) :] = []
+def iter_video_frames(video_path, fps, start=0, count=None):
+    # decode video enforcing fps to given fps, and yield (index, image)
+    # where index is 0-based frame index, i.e. image of '{index+1:06}.jpg'.
+    # frames are piped from ffmpeg as raw BGR and never written to disk.
+    # if start is given, ffmpeg seeks to the nearest keyframe a second before
+    # it and decodes from there, but only frames from start are yielded.
+    # the fps filter sees the original timestamps with -copyts, and frames are
+    # dropped by their output timestamps in 1/fps, so that the frame of each
+    # index is the same as decoded in a single pass, where index is the
+    # timestamp too, whatever the fps of source is.
+    # raises RuntimeError if ffmpeg fails, or if frames end more than a second
+    # before the duration in the header, e.g. of a truncated file, instead of
+    # taking it as the end of video.
+    width, height, duration = get_video_info(video_path)
+    expected = int(duration * fps)
+    if count is not None:
+        expected = min(expected, start + count)
+    frame_size = width * height * 3
+    command = ["ffmpeg"]
+    vf = f"fps={fps}"
+    if start > 0:
+        command += ["-copyts", "-start_at_zero", "-ss", f"{max(0, start / fps - 1)}"]
+        vf += f",trim=start_pts={start}"
+    command += ["-i", video_path, "-vf", vf]
+    if count is not None:
+        command += ["-frames:v", f"{count}"]
+    command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "-loglevel", "error"]
+    command += ["pipe:1"]
+    # error messages are kept in a file, which never blocks ffmpeg as a pipe
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=stderr, bufsize=frame_size
+    )
+    try:
+        index = start
+        while True:
+            with profiler.stage("decode", nbytes=frame_size):
+                buf = proc.stdout.read(frame_size)
+            if len(buf) < frame_size:
+                break
+            yield index, np.frombuffer(buf, np.uint8).reshape(height, width, 3)
+            index += 1
+        if proc.wait() != 0 or index < expected - fps:
+            stderr.seek(0)
+            message = stderr.read().decode("utf-8", "replace").strip()
+            raise RuntimeError(
+                f"ffmpeg failed to decode '{video_path}' with exit code "
+                f"{proc.returncode}, frames end at {index} of {expected}: "
+                + " ".join(message.splitlines()[-3:])
+            )
+    finally:
+        # stopped early when all utterances are done
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+        stderr.close()
+
+
+def crop_face(image, frame, max_width, max_height):
+    iframe = [max(0, int(x)) for x in frame]
+    crop_area = image[
+        iframe[2] : iframe[2] + max_height, iframe[1] : iframe[1] + max_width
+    ]
+    return cv2.resize(crop_area, (224, 224))
+
 
-    return header + frame_list + footer
+def frame_index(frame):
+    # 0-based index of the image for given line of ASD info
+    return max(0, int(frame[0]) - 1)
 
 
-def crop_video(utt_index, point_list, flist, outdir):
-    # calculate the maximum length of the part to crop
-    width_list, height_list = list(zip(*point_list))[3:]
-    max_width = max(list(map(int, width_list)))
-    max_height = max(list(map(int, height_list)))
+class FFmpegEncoder:
+    # encode cropped faces by piping raw frames into a ffmpeg process per
+    # utterance. if mux is True, audio of utterance '{name}.wav' must be cut
+    # in advance, and the same process writes '{name}_audio.mp4' as well.
+    def __init__(
+        self,
+        vcodec="libx264",
+        preset="ultrafast",
+        crf=None,
+        pix_fmt="yuv420p",
+        mux=True,
+    ):
+        self.vcodec = vcodec
+        self.preset = preset
+        self.crf = crf
+        self.pix_fmt = pix_fmt
+        self.mux = mux
 
-    video_path = os.path.join(outdir, utt_index + ".mp4")
-    vOut = cv2.VideoWriter(
-        video_path,
-        cv2.VideoWriter_fourcc(*"mp4v"),
-        25,
-        (224, 224),
+    def command(self, video_path):
+        command = ["ffmpeg", "-y", "-loglevel", "error"]
+        command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "224x224"]
+        command += ["-r", "25", "-i", "pipe:0"]
+        if self.mux:
+            command += ["-i", os.path.splitext(video_path)[0] + ".wav"]
+        command += ["-c:v", self.vcodec, "-pix_fmt", self.pix_fmt]
+        if self.preset:
+            command += ["-preset", self.preset]
+        if self.crf is not None:
+            command += ["-crf", f"{self.crf}"]
+        if not self.mux:
+            return command + [video_path]
+        # video is encoded once, and written into both of files by tee muxer
+        video_out, ext = os.path.splitext(video_path)
+        command += ["-map", "0:v", "-map", "1:a", "-c:a", "aac", "-f", "tee"]
+        return command + [f"[select=v]{video_path}|{video_out}_audio{ext}"]
+
+
+def get_encoder(args):
+    # returns None for '--encoder opencv'
+    if args.encoder == "opencv":
+        return None
+    return FFmpegEncoder(
+        args.vcodec, args.preset, args.crf, args.pix_fmt, not args.skip_mux
     )
 
+
+class ClipWriter:
+    # write cropped faces of an utterance into mp4 file, by OpenCV or by
+    # FFmpegEncoder if given. with roi 'bgr' or 'gray', they are also stored
+    # as uint8 array of (T, 224, 224, 3) or (T, 224, 224) in npy file, which
+    # can be loaded by numpy.load(path, mmap_mode="r") without decoding.
+    def __init__(self, video_path, nframes, roi="none", encoder=None):
+        self.vOut = None
+        self.proc = None
+        if encoder is None:
+            self.vOut = cv2.VideoWriter(
+                video_path,
+                cv2.VideoWriter_fourcc(*"mp4v"),
+                25,
+                (224, 224),
+            )
+        else:
+            self.proc = subprocess.Popen(
+                encoder.command(video_path), stdin=subprocess.PIPE
+            )
+        self.roi = roi
+        self.rois = None
+        self.pos = 0
+        if roi != "none":
+            shape = (nframes, 224, 224, 3) if roi == "bgr" else (nframes, 224, 224)
+            self.rois = np.lib.format.open_memmap(
+                os.path.splitext(video_path)[0] + ".npy",
+                mode="w+",
+                dtype=np.uint8,
+                shape=shape,
+            )
+
+    def write(self, face):
+        with profiler.stage("encode", nbytes=face.nbytes):
+            if self.proc is not None:
+                self.proc.stdin.write(np.ascontiguousarray(face).tobytes())
+            else:
+                self.vOut.write(face)
+            if self.rois is not None:
+                if self.roi == "gray":
+                    face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+                self.rois[self.pos] = face
+        self.pos += 1
+
+    def release(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            with profiler.stage("encode", count=0):
+                returncode = self.proc.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, "ffmpeg")
+        else:
+            self.vOut.release()
+        if self.rois is not None:
+            self.rois.flush()
+            del self.rois
+            self.rois = None
+
+
+class FrameCache:
+    # decoded images of jpg files shared by utterances overlapping in time.
+    # images are evicted in LRU order to keep them under max_bytes.
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def imread(self, path):
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = cv2.imread(path)
+        if image is not None and image.nbytes <= self.max_bytes:
+            self.images[path] = image
+            self.nbytes += image.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return image
+
+
+def partial_path(outdir, utt_index):
+    # outputs of an utterance are written with '.part' in their names, e.g.
+    # '000003.part.wav', and renamed when all of them are completed.
+    return os.path.join(outdir, utt_index + ".part.mp4")
+
+
+def final_path(path):
+    head, tail = os.path.split(path)
+    return os.path.join(head, tail.replace(".part", "", 1))
+
+
+def remove_partial(outdir):
+    # remove outputs left by runs stopped while processing
+    for path in glob.glob(os.path.join(outdir, "*.part*")):
+        os.remove(path)
+
+
+def crop_video(
+    utt_index, point_list, flist, outdir, cache=None, roi="none", encoder=None
+):
+    max_width, max_height = crop_size(point_list)
+    if cache is None:
+        cache = FrameCache()
+
+    video_path = partial_path(outdir, utt_index)
+    vOut = ClipWriter(video_path, len(point_list), roi, encoder)
+
     try:
         for index, frame in enumerate(point_list):
-            iframe = [max(0, int(x)) for x in frame]
-            image = cv2.imread(flist[max(0, min(len(flist) - 1, iframe[0] - 1))])
-            crop_area = image[
-                iframe[2] : iframe[2] + max_height, iframe[1] : iframe[1] + max_width
-            ]
-
-            vOut.write(cv2.resize(crop_area, (224, 224)))
+            with profiler.stage("read") as stage:
+                image = cache.imread(flist[min(len(flist) - 1, frame_index(frame))])
+                stage.nbytes = image.nbytes
+            with profiler.stage("crop"):
+                face = crop_face(image, frame, max_width, max_height)
+            vOut.write(face)
     except Exception:
         logging.error(f"ERROR while processing {video_path}")
         raise
@@ -96,152 +409,784 @@ def crop_video(utt_index, point_list, flist, outdir):
     return video_path
 
 
-def combine_audio(video_path, audio_path, audio_start, audio_end):
-    video_out, ext = os.path.splitext(video_path)
-    audio_out = video_out + ".wav"
-    video_out = video_out + "_audio" + ext
-    command = (
-        f"ffmpeg -y -i {audio_path} -async 1 -ac 1 -vn -acodec pcm_s16le"
-        f" -ar 16000 -ss {audio_start} -to {audio_end} {audio_out}"
-        f" -loglevel panic"
-    )
-    print(command)
-    output = subprocess.check_call(command, shell=True, stdout=None)  # Crop audio file
+class CropJob:
+    # an utterance passed through stages of CropPipeline
+    def __init__(self, utt, outdir, writer_id):
+        self.utt = utt
+        self.regions = get_crop_regions(utt)
+        self.max_width, self.max_height = crop_size(self.regions)
+        self.video_path = partial_path(outdir, utt["utt_index"])
+        self.writer_id = writer_id
+        self.vOut = None
+        self.error = None
 
-    command = (
-        f"ffmpeg -y -i {video_path} -i {audio_out} -c:v copy -c:a aac"
-        f" {video_out} -loglevel panic"
-    )
-    output = subprocess.check_call(command, shell=True, stdout=None)
+
+class CropPipeline:
+    # crop utterances in threads of stages connected by bounded queues, i.e.
+    # a reader of jpg files, a cropper, and writers encoding clips of
+    # different utterances at once. OpenCV releases GIL while decoding,
+    # resizing and encoding, so the stages run in parallel. frames of an
+    # utterance always go through the same writer in order, so outputs are
+    # same as crop_video(). decoded images are at most depth per queue.
+    def __init__(self, flist, cache, roi="none", depth=8, num_writers=2, encoder=None):
+        self.flist = flist
+        self.cache = cache
+        self.roi = roi
+        self.encoder = encoder
+        self.crop_queue = queue.Queue(depth)
+        self.write_queues = [queue.Queue(depth) for _ in range(num_writers)]
+        self.done_queue = queue.Queue()
+
+    def read(self, jobs):
+        try:
+            for job in jobs:
+                try:
+                    for frame in job.regions:
+                        if job.error is not None:
+                            break
+                        with profiler.stage("read") as stage:
+                            image = self.cache.imread(
+                                self.flist[min(len(self.flist) - 1, frame_index(frame))]
+                            )
+                            stage.nbytes = image.nbytes
+                        self.crop_queue.put((job, frame, image))
+                except Exception as e:
+                    job.error = e
+                # end of the utterance
+                self.crop_queue.put((job, None, None))
+        finally:
+            self.crop_queue.put(None)
+
+    def crop(self):
+        while True:
+            item = self.crop_queue.get()
+            if item is None:
+                break
+            job, frame, image = item
+            face = None
+            if frame is not None:
+                if job.error is not None:
+                    continue
+                try:
+                    with profiler.stage("crop"):
+                        face = crop_face(image, frame, job.max_width, job.max_height)
+                except Exception as e:
+                    job.error = e
+                    continue
+            self.write_queues[job.writer_id].put((job, face))
+        for write_queue in self.write_queues:
+            write_queue.put(None)
+
+    def write(self, write_queue):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            job, face = item
+            try:
+                if face is None:
+                    if job.vOut is not None:
+                        job.vOut.release()
+                    self.done_queue.put(job)
+                elif job.error is None:
+                    if job.vOut is None:
+                        job.vOut = ClipWriter(
+                            job.video_path, len(job.regions), self.roi, self.encoder
+                        )
+                    job.vOut.write(face)
+            except Exception as e:
+                job.error = e
+                if face is None:
+                    self.done_queue.put(job)
+
+    def run(self, jobs):
+        # yield jobs in the given order as they are done
+        threads = [threading.Thread(target=self.read, args=(jobs,), daemon=True)]
+        threads.append(threading.Thread(target=self.crop, daemon=True))
+        for write_queue in self.write_queues:
+            threads.append(
+                threading.Thread(target=self.write, args=(write_queue,), daemon=True)
+            )
+        for thread in threads:
+            thread.start()
+
+        done = {}
+        for job in jobs:
+            while id(job) not in done:
+                finished = self.done_queue.get()
+                done[id(finished)] = finished
+            yield done.pop(id(job))
+
+        for thread in threads:
+            thread.join()
+
+
+def read_wav_info(audio_path):
+    # returns (audio_format, channels, sample_rate, bits, data offset,
+    # the number of bytes of data) from RIFF header of wav file
+    fmt, offset, size = None, None, None
+    filesize = os.path.getsize(audio_path)
+    with open(audio_path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                offset = f.tell()
+                # size may be invalid if wav was written to pipe
+                size = min(chunk_size, filesize - offset)
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    if fmt is None or offset is None:
+        return None
+    audio_format, channels, sample_rate, _, _, bits = fmt
+    return audio_format, channels, sample_rate, bits, offset, size
+
+
+class AudioSource:
+    # 16kHz mono 16bit source wav, memory-mapped once per video.
+    # utterance wavs are sliced from it without running ffmpeg.
+    # 'samples' is None if the format is different, then ffmpeg is used.
+    def __init__(self, audio_path, sample_rate=16000):
+        self.path = audio_path
+        self.sample_rate = sample_rate
+        self.samples = None
+
+        info = read_wav_info(audio_path)
+        # 1: PCM, 0xFFFE: WAVE_FORMAT_EXTENSIBLE
+        if info is not None and info[:4] in [
+            (1, 1, sample_rate, 16),
+            (0xFFFE, 1, sample_rate, 16),
+        ]:
+            offset, size = info[4:]
+            self.samples = np.memmap(
+                audio_path, dtype="<i2", mode="r", offset=offset, shape=(size // 2,)
+            )
+        else:
+            logging.warning(
+                f"{audio_path} is not {sample_rate}Hz mono 16bit wav. "
+                "ffmpeg is used to cut audio."
+            )
+
+
+def cut_audio(video_path, audio, audio_start, audio_end):
+    with profiler.stage("audio_cut") as stage:
+        audio_out = _cut_audio(video_path, audio, audio_start, audio_end)
+        stage.nbytes = os.path.getsize(audio_out) if profiler.enabled else 0
+    return audio_out
+
+
+def _cut_audio(video_path, audio, audio_start, audio_end):
+    # cut audio of utterance from source wav. audio_start and audio_end
+    # are aligned with video frames.
+    audio_out = os.path.splitext(video_path)[0] + ".wav"
+    if audio.samples is None:
+        command = (
+            f"ffmpeg -y -i {audio.path} -async 1 -ac 1 -vn -acodec pcm_s16le"
+            f" -ar 16000 -ss {audio_start} -to {audio_end} {audio_out}"
+            f" -loglevel panic"
+        )
+        print(command)
+        output = subprocess.check_call(command, shell=True, stdout=None)
+        return audio_out
+
+    start = int(round(audio_start * audio.sample_rate))
+    end = int(round(audio_end * audio.sample_rate))
+    with wave.open(audio_out, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(audio.sample_rate)
+        f.writeframes(audio.samples[start:end].tobytes())
     return audio_out
 
 
-def crop_all_utts(args, frames_dir, utt_dir):
+class AudioMuxer:
+    # combine utterance video and audio into '_audio.mp4'.
+    # a single ffmpeg process muxes up to batch_size utterances.
+    def __init__(self, batch_size=16, enabled=True):
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.pairs = []
+
+    def add(self, video_path, audio_path):
+        # returns path of '_audio.mp4' which is created on flush()
+        if not self.enabled:
+            return None
+        self.pairs.append((video_path, audio_path))
+        video_out, ext = os.path.splitext(video_path)
+        return video_out + "_audio" + ext
+
+    def flush(self):
+        if len(self.pairs) == 0:
+            return
+        inputs, outputs = [], []
+        for i, (video_path, audio_path) in enumerate(self.pairs):
+            video_out, ext = os.path.splitext(video_path)
+            video_out = video_out + "_audio" + ext
+            inputs += ["-i", video_path, "-i", audio_path]
+            outputs += ["-map", f"{2 * i}:v", "-map", f"{2 * i + 1}:a"]
+            outputs += ["-c:v", "copy", "-c:a", "aac", video_out]
+        command = ["ffmpeg", "-y"] + inputs + outputs + ["-loglevel", "panic"]
+        try:
+            with profiler.stage("mux", count=len(self.pairs)):
+                subprocess.check_call(command, stdout=None)
+        finally:
+            # a failed batch is not muxed again with the next one
+            self.pairs = []
+
+
+class ShardWriter:
+    # write files of utterances into tar files of about max_bytes each,
+    # e.g. utts-00000.tar, with index file utts-00000.idx where each line is
+    # 'utt_index name offset size' to read a file at the offset of tar file.
+    # an utterance is listed in a single index file, i.e. the one of the shard
+    # of its latest outputs, even if it was cropped again on resume.
+    def __init__(self, prefix, max_bytes, append=False):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.num_shards = 0
+        self.tar = None
+        if append:
+            # shards without index files were left open by a crashed run, and
+            # their utterances are not done. they are removed, and new shards
+            # are added after the ones of previous runs.
+            for path in glob.glob(f"{prefix}-?????.tar"):
+                if not os.path.exists(path[:-4] + ".idx"):
+                    os.remove(path)
+            shards = glob.glob(f"{prefix}-?????.tar")
+            self.num_shards = max([int(x[-9:-4]) + 1 for x in shards], default=0)
+
+    def shard_path(self, n):
+        return f"{self.prefix}-{n:05}.tar"
+
+    def add(self, utt_index, paths):
+        # move files into the current shard, and return their names in it
+        if self.tar is None:
+            self.tar = tarfile.open(self.shard_path(self.num_shards), "w")
+            self.index = []
+        names = []
+        for path in paths:
+            name = os.path.basename(final_path(path))
+            tarinfo = self.tar.gettarinfo(path, arcname=name)
+            with open(path, "rb") as f:
+                self.tar.addfile(tarinfo, f)
+            # data is followed by padding to the multiple of BLOCKSIZE
+            blocks = (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+            offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+            self.index.append((utt_index, name, offset, tarinfo.size))
+            os.remove(path)
+            names.append(f"{self.shard_path(self.num_shards)}:{name}")
+        if self.tar.offset >= self.max_bytes:
+            self.close()
+        return names
+
+    def close(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        idx_path = f"{self.prefix}-{self.num_shards:05}.idx"
+        with open(idx_path, "w") as f:
+            for utt_index, name, offset, size in self.index:
+                f.write(f"{utt_index} {name} {offset} {size}\n")
+        self.drop_superseded(idx_path, set(x[0] for x in self.index))
+        self.tar = None
+        self.num_shards += 1
+
+    def drop_superseded(self, idx_path, utt_indices):
+        # remove entries of utterances in the shard of idx_path from the index
+        # files of the other shards, which have their outputs of previous runs
+        for path in glob.glob(f"{self.prefix}-?????.idx"):
+            if path == idx_path:
+                continue
+            with open(path) as f:
+                lines = f.readlines()
+            kept = [x for x in lines if x.split(" ", 1)[0] not in utt_indices]
+            if len(kept) < len(lines):
+                with open(path + ".tmp", "w") as f:
+                    f.writelines(kept)
+                os.replace(path + ".tmp", path)
+
+    def remove_stale(self):
+        # remove shards left by previous runs
+        for path in glob.glob(f"{self.prefix}-?????.tar"):
+            if int(path[-9:-4]) >= self.num_shards:
+                os.remove(path)
+                if os.path.exists(path[:-4] + ".idx"):
+                    os.remove(path[:-4] + ".idx")
+
+
+class Journal:
+    # completion journal of utterances of a video. each line is
+    # 'utt_index fingerprint status crop_path audio_path', and the last line
+    # of an utterance is effective. fingerprint is the hash of ASD info file
+    # and crop parameters, so that changed utterances are processed again.
+    def __init__(self, path, params, resume=True):
+        self.path = path
+        self.params = params
+        self.resume = resume
+        self.entries = {}
+        if not os.path.exists(path):
+            return
+        if not resume:
+            os.remove(path)
+            return
+        line = "\n"
+        for line in open(path, encoding="utf-8", errors="replace"):
+            utt_index, *entry = line.rstrip("\n").split("\t")
+            # a line may be truncated if the previous run crashed in record()
+            if len(entry) != 4 or not line.endswith("\n"):
+                logging.warning(f"malformed line in {path} skipped: {line!r}")
+                continue
+            self.entries[utt_index] = entry
+        if not line.endswith("\n"):
+            # new lines are not appended to the truncated one
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    def fingerprint(self, utt):
+        h = hashlib.sha1(self.params.encode("utf-8"))
+        with open(utt["txt_path"], "rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def done_entry(self, utt):
+        # returns (crop_path, audio_path) if utterance is done and unchanged
+        entry = self.entries.get(utt["utt_index"])
+        if entry is None or entry[1] != "done":
+            return None
+        fingerprint, _, crop_path, audio_path = entry
+        if fingerprint != self.fingerprint(utt):
+            return None
+        # outputs in tar shards are referred to as 'shard.tar:name', and the
+        # shard must have been closed with its index file
+        for path in [crop_path, audio_path]:
+            if ".tar:" in path:
+                path = path.rsplit(":", 1)[0][:-4] + ".idx"
+            if not os.path.exists(path):
+                return None
+        return crop_path, audio_path
+
+    def record(self, utt, status, crop_path="-", audio_path="-"):
+        entry = [self.fingerprint(utt), status, crop_path, audio_path]
+        self.entries[utt["utt_index"]] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\t".join([utt["utt_index"]] + entry) + "\n")
+
+
+def load_shard_index(idx_path):
+    # returns {utt_index: {name: (offset, size)}} of a shard
+    index = {}
+    for line in open(idx_path):
+        utt_index, name, offset, size = line.split()
+        index.setdefault(utt_index, {})[name] = (int(offset), int(size))
+    return index
+
+
+class UttOutputs:
+    # outputs of utterances are completed in batches, since '_audio.mp4' files
+    # are created by AudioMuxer. with '--output-format tar', outputs are moved
+    # into tar shards.
+    def __init__(self, args, utt_dir, journal):
+        # '_audio.mp4' is written by FFmpegEncoder with '--encoder ffmpeg'
+        self.muxed = args.encoder == "ffmpeg" and not args.skip_mux
+        self.muxer = AudioMuxer(
+            args.mux_batch_size, not args.skip_mux and not self.muxed
+        )
+        self.journal = journal
+        self.shards = None
+        if args.output_format == "tar":
+            prefix = os.path.join(os.path.dirname(utt_dir), "utts")
+            self.shards = ShardWriter(
+                prefix, args.shard_size_mb * 1024 * 1024, journal.resume
+            )
+        self.save_roi = args.save_roi
+        self.pending = []
+        self.failed = 0
+        # utterances in the open shard, which are done when it is closed
+        self.in_shard = []
+
+    def add(self, utt, crop_path, audio_path, txt_path):
+        paths = [crop_path, audio_path, txt_path]
+        if self.save_roi != "none":
+            paths.append(os.path.splitext(crop_path)[0] + ".npy")
+        video_out = self.muxer.add(crop_path, audio_path)
+        if self.muxed:
+            video_out, ext = os.path.splitext(crop_path)
+            video_out = video_out + "_audio" + ext
+        if video_out is not None:
+            paths.append(video_out)
+        self.pending.append((utt, paths))
+        if len(self.pending) >= self.muxer.batch_size:
+            self.flush()
+
+    def flush(self):
+        # failures are recorded for the utterances of the batch, and counted
+        # in self.failed, not raised to the utterance which triggered flush
+        pending, self.pending = self.pending, []
+        try:
+            self.muxer.flush()
+        except Exception:
+            logging.exception(f"ERROR while muxing {len(pending)} utterances")
+            for utt, _ in pending:
+                self.journal.record(utt, "failed")
+            self.failed += len(pending)
+            return
+        for utt, paths in pending:
+            try:
+                with profiler.stage("finalize"):
+                    if self.shards is not None:
+                        paths = self.shards.add(utt["utt_index"], paths)
+                    else:
+                        for path in paths:
+                            os.replace(path, final_path(path))
+                        paths = [final_path(x) for x in paths]
+            except Exception:
+                logging.exception(f"ERROR while processing {utt['utt_id']}")
+                self.journal.record(utt, "failed")
+                self.failed += 1
+                continue
+            if self.shards is None:
+                self.done(utt, paths)
+                continue
+            # the index file of shard is written when it is closed. utterances
+            # are not done before that, so that they are cropped again on
+            # resume if the run crashed while the shard was open.
+            self.in_shard.append((utt, paths))
+            if self.shards.tar is None:
+                self.done_shard()
+
+    def done(self, utt, paths):
+        self.journal.record(utt, "done", paths[0], paths[1])
+        print_utt_info(utt, paths[0], paths[1])
+
+    def done_shard(self):
+        for utt, paths in self.in_shard:
+            self.done(utt, paths)
+        self.in_shard = []
+
+    def close(self):
+        # returns the number of utterances failed in flush
+        self.flush()
+        if self.shards is not None:
+            self.shards.close()
+            self.done_shard()
+            if not self.journal.resume:
+                self.shards.remove_stale()
+        return self.failed
+
+
+def load_utts(args):
     # get vidio and audio name
     audio_path = os.path.splitext(args.video_path)[0] + ".wav"
     fileid = os.path.basename(audio_path)[:-4]
 
-    # get a list of txt files in script files
+    # parse all ASD info files of the video at once, or load them from cache
     txt_dir = os.path.join(args.asdinfo_dir, fileid)
-    txt_list = glob.glob(os.path.join(txt_dir, "??????.txt"))
-    if len(txt_list) == 0:
+    # dry run creates meta files only, and never writes the cache
+    cache_path = None
+    if not args.no_asd_cache and not args.dry_run:
+        cache_path = os.path.join(args.save_root, fileid, "asdinfo.npz")
+    index = load_asd_index(txt_dir, cache_path)
+    if len(index) == 0:
         logging.error(f"No ASD info found for '{fileid}'. Exit.")
         sys.exit(-1)
+
+    if (index.audio_ms[:, 0] < 0).any():
+        raise ValueError("The audio start frame cannot be negative.")
+
+    audio_start_frame = (index.audio_ms[:, 0] / 1000 * index.fps).astype(int) + 1
+    audio_end_frame = (index.audio_ms[:, 1] / 1000 * index.fps).astype(int) + 1
+    audio_start_sec = (audio_start_frame - 1) / index.fps
+    audio_end_sec = (audio_end_frame - 1) / index.fps
+
+    utts = []
+    for i in range(len(index)):
+        utt_index = index.utt_index(i)
+        utts.append(
+            {
+                "utt_index": utt_index,
+                "utt_id": f"{fileid}:{int(utt_index):06}",
+                "script": str(index.scripts[i]),
+                "audio_start_frame": int(audio_start_frame[i]),
+                "audio_end_frame": int(audio_end_frame[i]),
+                "audio_start_sec": float(audio_start_sec[i]),
+                "audio_end_sec": float(audio_end_sec[i]),
+                "boxes": index.utt_boxes(i),
+                "txt_path": os.path.join(txt_dir, index.names[i]),
+            }
+        )
+    return audio_path, utts
+
+
+def get_crop_regions(utt):
+    # adjust frame length according to audio start and end info
+    return adjust_av_index(
+        utt["audio_start_frame"], utt["audio_end_frame"], utt["boxes"]
+    )
+
+
+def print_utt_info(utt, crop_path, audio_path):
+    print(
+        f"{utt['utt_id']}\t"
+        f"{crop_path}\t"
+        f"{audio_path}\t"
+        f"{utt['audio_end_frame']-utt['audio_start_frame']+1}\t"
+        f"{int((utt['audio_end_sec']-utt['audio_start_sec'])*16000)}\t"
+        f"{utt['script']}"
+    )
+
+
+def cut_utt_audio(utt, crop_path, audio):
+    return cut_audio(crop_path, audio, utt["audio_start_sec"], utt["audio_end_sec"])
+
+
+def cut_all_audio(utts, utt_dir, audio):
+    # FFmpegEncoder muxes audio while encoding, so audio is cut in advance
+    for utt in utts:
+        cut_utt_audio(utt, partial_path(utt_dir, utt["utt_index"]), audio)
+
+
+def finish_utt(utt, crop_path, audio, outputs):
+    # cut audio, and combine it with video
+    if outputs.muxed:
+        audio_path_out = os.path.splitext(crop_path)[0] + ".wav"
     else:
-        txt_list.sort()
+        audio_path_out = cut_utt_audio(utt, crop_path, audio)
+
+    txt_path = crop_path[:-4] + ".txt"
+    with open(txt_path, "w") as ofp:
+        ofp.write(f"{utt['script']}\n")
+
+    outputs.add(utt, crop_path, audio_path_out, txt_path)
+
+
+def crop_all_utts(args, frames_dir, utt_dir, audio_path, utts, journal):
+    audio = AudioSource(audio_path)
+    outputs = UttOutputs(args, utt_dir, journal)
+    encoder = get_encoder(args)
+    if outputs.muxed:
+        cut_all_audio(utts, utt_dir, audio)
 
     flist = glob.glob(os.path.join(frames_dir, "??????.jpg"))
     flist.sort()
 
+    cache = FrameCache(args.frame_cache_mb * 1024 * 1024)
+    if args.frame_cache_mb > 0:
+        # utterances overlapping in time are processed one after another
+        utts = sorted(utts, key=lambda x: x["audio_start_frame"])
+
     # crop video based on the data of txt
-    for txt_path in txt_list:
-        utt_index = os.path.splitext(os.path.split(txt_path)[-1])[0]
-        utt_id = f"{fileid}:{int(utt_index):06}"
-        lines = open(txt_path).readlines()
-
-        lineno = 0
-        while lines[lineno][0] == "#" or lines[lineno].strip() == "":
-            w = lines[lineno].split(":")
-            if w[0] == "# Script":
-                script = " ".join(w[1].split())
-            elif w[0] == "# ImageSize":
-                image_size_x, image_size_y = [int(x) for x in w[1].split()]
-            elif w[0] == "# FPS":
-                fps = int(w[1])
-            elif w[0] == "# Audio Duration(ms)":
-                audio_start, audio_end = [int(x) for x in w[1].split()]
-            lineno += 1
-
-        audio_start_frame = int(audio_start / 1000 * fps) + 1
-        audio_end_frame = int(audio_end / 1000 * fps) + 1
-        audio_start_sec = (audio_start_frame - 1) / fps
-        audio_end_sec = (audio_end_frame - 1) / fps
-
-        if audio_start < 0:
-            raise ValueError("The audio start frame cannot be negative.")
-
-        # face coordinates per frame, width & height data
-        frame_list = [data.split(" ") for data in lines[lineno:]]
-
-        # adjust frame length according to audio start and end info
-        crop_regions = adjust_av_index(audio_start_frame, audio_end_frame, frame_list)
-
-        # crop facial area from images and generate avi
-        crop_path = crop_video(utt_index, crop_regions, flist, utt_dir)
-
-        # combine audio
-        audio_path_out = combine_audio(
-            crop_path, audio_path, audio_start_sec, audio_end_sec
+    failed = 0
+    if args.pipeline_depth > 0:
+        jobs = [CropJob(utt, utt_dir, n % args.writers) for n, utt in enumerate(utts)]
+        pipeline = CropPipeline(
+            flist, cache, args.save_roi, args.pipeline_depth, args.writers, encoder
         )
+        for job in pipeline.run(jobs):
+            try:
+                if job.error is not None:
+                    logging.error(f"ERROR while processing {job.video_path}")
+                    raise job.error
+                finish_utt(job.utt, job.video_path, audio, outputs)
+            except Exception:
+                logging.exception(f"ERROR while processing {job.utt['utt_id']}")
+                journal.record(job.utt, "failed")
+                failed += 1
+    else:
+        for utt in utts:
+            try:
+                # crop facial area from images and generate avi
+                crop_path = crop_video(
+                    utt["utt_index"],
+                    get_crop_regions(utt),
+                    flist,
+                    utt_dir,
+                    cache,
+                    args.save_roi,
+                    encoder,
+                )
 
-        with open(crop_path[:-4] + ".txt", "w") as ofp:
-            ofp.write(f"{script}\n")
+                finish_utt(utt, crop_path, audio, outputs)
+            except Exception:
+                logging.exception(f"ERROR while processing {utt['utt_id']}")
+                journal.record(utt, "failed")
+                failed += 1
 
-        print(
-            f"{utt_id}\t"
-            f"{crop_path}\t"
-            f"{audio_path_out}\t"
-            f"{audio_end_frame-audio_start_frame+1}\t"
-            f"{int((audio_end_sec-audio_start_sec)*16000)}\t"
-            f"{script}"
+    failed += outputs.close()
+    if args.frame_cache_mb > 0:
+        total = max(1, cache.hits + cache.misses)
+        logging.info(
+            f"frame cache: {cache.hits} hits, {cache.misses} misses "
+            f"({cache.hits / total * 100:.1f}% hit rate)"
         )
+    return failed
 
-    return
 
+class UttStream:
+    # state of an utterance being cropped from decoded frames
+    def __init__(self, utt, utt_dir, roi="none", encoder=None):
+        self.utt = utt
+        self.roi = roi
+        self.encoder = encoder
+        self.regions = get_crop_regions(utt)
+        self.max_width, self.max_height = crop_size(self.regions)
+        self.start = frame_index(self.regions[0])
+        self.end = frame_index(self.regions[-1])
+        self.pos = 0
+        self.video_path = partial_path(utt_dir, utt["utt_index"])
+        self.vOut = None
 
-def write_utt_info(args, utt_dir):
-    # get vidio and audio name
-    audio_path = os.path.splitext(args.video_path)[0] + ".wav"
-    fileid = os.path.basename(audio_path)[:-4]
+    def feed(self, index, image):
+        # write every line of ASD info which refers to the frame at index
+        if self.vOut is None:
+            self.vOut = ClipWriter(
+                self.video_path, len(self.regions), self.roi, self.encoder
+            )
+        try:
+            while (
+                self.pos < len(self.regions)
+                and frame_index(self.regions[self.pos]) <= index
+            ):
+                frame = self.regions[self.pos]
+                with profiler.stage("crop"):
+                    face = crop_face(image, frame, self.max_width, self.max_height)
+                self.vOut.write(face)
+                self.pos += 1
+        except Exception:
+            logging.error(f"ERROR while processing {self.video_path}")
+            raise
 
-    # get a list of txt files in script files
-    txt_dir = os.path.join(args.asdinfo_dir, fileid)
-    txt_list = glob.glob(os.path.join(txt_dir, "??????.txt"))
-    if len(txt_list) == 0:
-        logging.error(f"No ASD info found for '{fileid}'. Exit.")
-        sys.exit(-1)
+    def flush(self, image):
+        # frames after the end of video refer to the last frame
+        self.feed(float("inf"), image)
+
+    def done(self):
+        return self.pos >= len(self.regions)
+
+    def release(self):
+        self.vOut.release()
+        return self.video_path
+
+
+def merge_frame_ranges(streams, merge_gap):
+    # merge frame ranges of utterances if they are closer than merge_gap
+    ranges = []
+    for stream in sorted(streams, key=lambda x: x.start):
+        if len(ranges) > 0 and stream.start - ranges[-1][1] <= merge_gap:
+            ranges[-1][1] = max(ranges[-1][1], stream.end)
+        else:
+            ranges.append([stream.start, stream.end])
+    return ranges
+
+
+def iter_sparse_frames(args, streams):
+    # decode only frame ranges covered by utterances, seeking to each of them.
+    # if utterances cover most of video, video is decoded in a single pass.
+    ranges = merge_frame_ranges(streams, int(args.sparse_merge_gap * args.fps))
+    _, _, duration = get_video_info(args.video_path)
+    covered = sum(end - start + 1 for start, end in ranges)
+    coverage = covered / max(1, duration * args.fps)
+    logging.info(
+        f"{len(ranges)} frame ranges, {covered} frames "
+        f"({coverage * 100:.1f}% of video) to decode"
+    )
+    if coverage > args.sparse_max_coverage:
+        yield from iter_video_frames(args.video_path, args.fps)
+        return
+
+    for start, end in ranges:
+        yield from iter_video_frames(args.video_path, args.fps, start, end - start + 1)
+
+
+def stream_all_utts(args, utt_dir, audio_path, utts, journal):
+    # decode video once, and crop every utterance covering each decoded frame.
+    # no intermediate frames are written to disk.
+    audio = AudioSource(audio_path)
+    outputs = UttOutputs(args, utt_dir, journal)
+    encoder = get_encoder(args)
+    if outputs.muxed:
+        cut_all_audio(utts, utt_dir, audio)
+
+    streams = [UttStream(utt, utt_dir, args.save_roi, encoder) for utt in utts]
+    pending = sorted(streams, key=lambda x: x.start, reverse=True)
+    active = []
+
+    if args.engine == "sparse":
+        frames = iter_sparse_frames(args, streams)
     else:
-        txt_list.sort()
-
-    for txt_path in txt_list:
-        utt_index = os.path.splitext(os.path.split(txt_path)[-1])[0]
-        utt_id = f"{fileid}:{utt_index:06}"
-        lines = open(txt_path).readlines()
-
-        lineno = 0
-        while lines[lineno][0] == "#":
-            w = lines[lineno].split(":")
-            if w[0] == "# Script":
-                script = " ".join(w[1].split())
-            elif w[0] == "# ImageSize":
-                image_size_x, image_size_y = [int(x) for x in w[1].split()]
-            elif w[0] == "# FPS":
-                fps = int(w[1])
-            elif w[0] == "# Audio Duration(ms)":
-                audio_start, audio_end = [int(x) for x in w[1].split()]
-            lineno += 1
-
-        audio_start_frame = int(audio_start / 1000 * fps) + 1
-        audio_end_frame = int(audio_end / 1000 * fps) + 1
-        audio_start_sec = (audio_start_frame - 1) / fps
-        audio_end_sec = (audio_end_frame - 1) / fps
-
-        if audio_start < 0:
-            raise ValueError("The audio start frame cannot be negative.")
-
-        crop_path = os.path.join(utt_dir, utt_index + ".avi")
+        frames = iter_video_frames(args.video_path, args.fps)
+
+    def finish_stream(stream, image=None):
+        # returns False if the utterance failed
+        try:
+            if image is not None:
+                stream.flush(image)
+            finish_utt(stream.utt, stream.release(), audio, outputs)
+            return True
+        except Exception:
+            logging.exception(f"ERROR while processing {stream.utt['utt_id']}")
+            journal.record(stream.utt, "failed")
+            return False
+
+    failed = 0
+    image = None
+    try:
+        for index, image in frames:
+            while len(pending) > 0 and pending[-1].start <= index:
+                active.append(pending.pop())
+
+            for stream in active[:]:
+                try:
+                    stream.feed(index, image)
+                except Exception:
+                    logging.exception(f"ERROR while processing {stream.utt['utt_id']}")
+                    journal.record(stream.utt, "failed")
+                    active.remove(stream)
+                    failed += 1
+
+            for stream in [x for x in active if x.done()]:
+                active.remove(stream)
+                failed += not finish_stream(stream)
+
+            if len(active) == 0 and len(pending) == 0:
+                break
+    except RuntimeError:
+        # decoding failed, so frames of the remaining utterances are unknown
+        logging.exception(f"ERROR while decoding '{args.video_path}'")
+        for stream in active + pending[::-1]:
+            journal.record(stream.utt, "failed")
+            failed += 1
+        failed += outputs.close()
+        return failed
+
+    if image is None:
+        logging.error(f"No frames decoded from '{args.video_path}'. Exit.")
+        sys.exit(-1)
+
+    for stream in active + pending[::-1]:
+        failed += not finish_stream(stream, image)
+
+    failed += outputs.close()
+    return failed
+
+
+def write_utt_info(args, utt_dir):
+    _, utts = load_utts(args)
+    for utt in utts:
+        crop_path = os.path.join(utt_dir, utt["utt_index"] + ".mp4")
         audio_path = os.path.splitext(crop_path)[0] + ".wav"
-        print(
-            f"{utt_id}\t"
-            f"{crop_path}\t"
-            f"{audio_path}\t"
-            f"{audio_end_frame-audio_start_frame+1}\t"
-            f"{int((audio_end_sec-audio_start_sec)*16000)}\t"
-            f"{script}"
-        )
+        print_utt_info(utt, crop_path, audio_path)
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(description="Crop KMSAV video data")
     parser.add_argument(
         "--asdinfo-dir", type=str, required=True, help="Script root dir"
@@ -257,25 +1202,220 @@ if __name__ == "__main__":
     )
     parser.add_argument("--dry-run", action="store_true", help="create meta files only")
     parser.add_argument("--fps", type=int, help="video fps", default=25)
+    parser.add_argument(
+        "--no-asd-cache",
+        action="store_true",
+        help="do not cache parsed ASD info into 'asdinfo.npz' in save root",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["frames", "stream", "sparse"],
+        default="frames",
+        help="'frames' extracts all frames into jpg files first, "
+        "'stream' crops utterances while decoding video without any jpg files, "
+        "'sparse' is same as 'stream' but decodes only frames of utterances",
+    )
+    parser.add_argument(
+        "--frame-cache-mb",
+        type=int,
+        default=0,
+        help="memory budget(MB) of decoded frames shared by utterances "
+        "overlapping in time for '--engine frames'. 0 disables the cache",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=0,
+        help="read, crop and encode frames in threads connected by queues of "
+        "this size for '--engine frames'. 0 runs them serially",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=2,
+        help="the number of threads encoding clips at once with '--pipeline-depth'",
+    )
+    parser.add_argument(
+        "--sparse-merge-gap",
+        type=float,
+        default=5.0,
+        help="frame ranges closer than this(sec) are decoded together "
+        "for '--engine sparse'",
+    )
+    parser.add_argument(
+        "--sparse-max-coverage",
+        type=float,
+        default=0.8,
+        help="decode whole video in a single pass for '--engine sparse' "
+        "if utterances cover more than this ratio of video",
+    )
+    parser.add_argument(
+        "--mux-batch-size",
+        type=int,
+        default=16,
+        help="the number of utterances muxed into '_audio.mp4' by one ffmpeg",
+    )
+    parser.add_argument(
+        "--skip-mux", action="store_true", help="do not create '_audio.mp4' files"
+    )
+    parser.add_argument(
+        "--encoder",
+        choices=["opencv", "ffmpeg"],
+        default="opencv",
+        help="'opencv' encodes clips with mp4v and muxes audio by another "
+        "ffmpeg, 'ffmpeg' pipes frames into a ffmpeg per utterance which "
+        "encodes them with --vcodec and muxes audio at once",
+    )
+    parser.add_argument(
+        "--vcodec", type=str, default="libx264", help="codec of '--encoder ffmpeg'"
+    )
+    parser.add_argument(
+        "--preset",
+        type=str,
+        default="ultrafast",
+        help="codec preset of '--encoder ffmpeg'. empty string for no preset",
+    )
+    parser.add_argument(
+        "--crf",
+        type=int,
+        default=None,
+        help="constant rate factor of '--encoder ffmpeg', e.g. 0 for "
+        "lossless libx264",
+    )
+    parser.add_argument(
+        "--pix-fmt",
+        type=str,
+        default="yuv420p",
+        help="pixel format of '--encoder ffmpeg', e.g. yuv444p for lossless",
+    )
+    parser.add_argument(
+        "--save-roi",
+        choices=["none", "bgr", "gray"],
+        default="none",
+        help="also save cropped faces as uint8 array into memory-mappable "
+        "npy file per utterance",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["files", "tar"],
+        default="files",
+        help="'files' writes files of each utterance into utts dir, "
+        "'tar' writes them into a few tar shards with offset index per video",
+    )
+    parser.add_argument(
+        "--shard-size-mb",
+        type=int,
+        default=1024,
+        help="size(MB) of each tar shard for '--output-format tar'",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="process all utterances again, ignoring 'journal.txt' of "
+        "utterances done by previous runs",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="measure time, count and bytes of each stage, "
+        "and write them into 'profile.json' in save root",
+    )
     parser.add_argument("video_path", type=str, help="video id")
-    args = parser.parse_args()
+    return parser
+
+
+def save_profile(path, args, num_utts):
+    # write profile of the video into json file, and return it
+    if not profiler.enabled:
+        return None
+    report = profiler.report(
+        video_path=args.video_path, engine=args.engine, utterances=num_utts
+    )
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"profile of {num_utts} utterances: {path}")
+    log_profile(report)
+    return report
+
+
+def get_crop_params(args):
+    # parameters changing outputs, which are part of fingerprints in journal
+    params = (
+        f"fps={args.fps} save_roi={args.save_roi} "
+        f"output_format={args.output_format} mux={not args.skip_mux}"
+    )
+    if args.encoder != "opencv":
+        params += (
+            f" encoder={args.encoder} vcodec={args.vcodec} preset={args.preset}"
+            f" crf={args.crf} pix_fmt={args.pix_fmt}"
+        )
+    return params
+
+
+def main(cmd=None):
+    parser = get_parser()
+    args = parser.parse_args(cmd)
 
     # create directories to store output files
     # the directory structure is as follows:
     # output/
     # └── fileid/
-    #     ├── frames/
-    #     └── utts/
+    #     ├── frames/ (only for '--engine frames')
+    #     ├── utts/
+    #     └── journal.txt
     frames_dir, utt_dir = init_save_root(args)
 
-    # convert all frames into output/fileid/frames/ directory.
-    # if there exists '000001.jpg' file already, conversion is skipped.
-    if not args.dry_run:
-        avi2images(args.video_path, frames_dir, args.fps)
-
-    # For given fileid, video files are extracted corresponding to
-    # all utterances described in the script file.
     if args.dry_run:
         write_utt_info(args, utt_dir)
-    else:
-        crop_all_utts(args, frames_dir, utt_dir)
+        return
+
+    profiler.reset(args.profile)
+    fileid = os.path.basename(os.path.dirname(utt_dir))
+    profile_path = os.path.join(args.save_root, fileid, "profile.json")
+
+    # utterances already done and not changed since then are skipped
+    with profiler.stage("asd"):
+        audio_path, utts = load_utts(args)
+    journal = Journal(
+        os.path.join(os.path.dirname(utt_dir), "journal.txt"),
+        get_crop_params(args),
+        not args.no_resume,
+    )
+    todo = []
+    for utt in utts:
+        entry = journal.done_entry(utt)
+        if entry is None:
+            todo.append(utt)
+        else:
+            print_utt_info(utt, *entry)
+    if len(todo) < len(utts):
+        logging.info(f"{len(utts) - len(todo)} of {len(utts)} utterances are done")
+    if len(todo) == 0:
+        return
+    remove_partial(utt_dir)
+
+    try:
+        # convert all frames into output/fileid/frames/ directory.
+        # if there exists '000001.jpg' file already, conversion is skipped.
+        if args.engine == "frames":
+            avi2images(args.video_path, frames_dir, args.fps)
+
+        # For given fileid, video files are extracted corresponding to
+        # all utterances described in the script file.
+        if args.engine in ["stream", "sparse"]:
+            failed = stream_all_utts(args, utt_dir, audio_path, todo, journal)
+        else:
+            failed = crop_all_utts(args, frames_dir, utt_dir, audio_path, todo, journal)
+    finally:
+        # profile is written even if cropping is failed
+        report = save_profile(profile_path, args, len(todo))
+
+    if failed > 0:
+        logging.error(f"{failed} of {len(todo)} utterances failed. Exit.")
+        sys.exit(-1)
+
+    return report
+
+
+if __name__ == "__main__":
+    main()
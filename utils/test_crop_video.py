@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Tests of crop_video.py run on a small synthetic video, e.g.
+#
+#   python3 -m pytest utils/test_crop_video.py
+
+import glob
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+CROP_VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crop_video.py")
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg is not installed"
+)
+
+
+def make_data(root, num_utts=4):
+    # 10 seconds of test pattern video with its wav, and ASD info files of
+    # utterances of 1.5 seconds each
+    video_path = os.path.join(root, "vid.mp4")
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", "testsrc2=size=160x120:rate=25", "-t", "10"]
+        + ["-c:v", "libx264", "-pix_fmt", "yuv420p", video_path],
+        check=True,
+    )
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", "sine=frequency=440:sample_rate=16000", "-t", "10"]
+        + ["-ac", "1", "-acodec", "pcm_s16le", video_path[:-4] + ".wav"],
+        check=True,
+    )
+    txt_dir = os.path.join(root, "asd", "vid")
+    os.makedirs(txt_dir)
+    for i in range(1, num_utts + 1):
+        write_asd_txt(txt_dir, i, f"utterance {i}")
+    return video_path
+
+
+def write_asd_txt(txt_dir, i, script):
+    start_ms = i * 2000
+    end_ms = start_ms + 1500
+    lines = [
+        f"# Script: {script}\n",
+        "# ImageSize: 160 120\n",
+        "# FPS: 25\n",
+        f"# Audio Duration(ms): {start_ms} {end_ms}\n",
+        "\n",
+    ]
+    for frame in range(start_ms // 40 + 1, end_ms // 40 + 1):
+        lines.append(f"{frame} 40 30 60 60\n")
+    with open(os.path.join(txt_dir, f"{i:06}.txt"), "w") as f:
+        f.writelines(lines)
+
+
+def run_crop(root, video_path, *options):
+    cmd = [sys.executable, CROP_VIDEO, "--asdinfo-dir", os.path.join(root, "asd")]
+    cmd += ["--save-root", os.path.join(root, "out")] + list(options) + [video_path]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+
+def read_journal(path):
+    # returns {utt_index: (status, crop_path)} of the last line of each
+    entries = {}
+    for line in open(path):
+        utt_index, _, status, crop_path, _ = line.rstrip("\n").split("\t")
+        entries[utt_index] = (status, crop_path)
+    return entries
+
+
+def test_resume_tar_index(tmp_path):
+    # an utterance cropped again on resume is in a new shard, and listed only
+    # in the index file of that shard
+    root = str(tmp_path)
+    video_path = make_data(root)
+    # '--shard-size-mb 0' closes a shard per utterance
+    options = ["--engine", "stream", "--output-format", "tar"]
+    options += ["--shard-size-mb", "0", "--skip-mux"]
+    run_crop(root, video_path, *options)
+
+    write_asd_txt(os.path.join(root, "asd", "vid"), 2, "utterance 2 changed")
+    run_crop(root, video_path, *options)
+
+    out_dir = os.path.join(root, "out", "vid")
+    shards = {}
+    for idx_path in sorted(glob.glob(os.path.join(out_dir, "utts-?????.idx"))):
+        for line in open(idx_path):
+            shards.setdefault(line.split()[0], set()).add(idx_path)
+    journal = read_journal(os.path.join(out_dir, "journal.txt"))
+    assert sorted(shards) == sorted(journal)
+    for utt_index, (status, crop_path) in journal.items():
+        assert status == "done"
+        shard = crop_path.rsplit(":", 1)[0][:-4] + ".idx"
+        assert shards[utt_index] == {shard}
+    # the changed utterance was moved into a shard after the ones of first run
+    assert journal["000002"][1] > journal["000004"][1]
@@ -3,61 +3,158 @@
 # transcription, and the second is the hypothesis.
 # Both input texts should be in the format of 'uttid' followed by sequence of words.
 # 'pip install levenshtein' is required.
+#
+# --unit char computes CER without splitting text by split_char.py, and
+# --unit jamo computes error rate of Hangul jamo, e.g. '한' -> 'ㅎㅏㄴ'.
+# With --list ../../data/list.txt, error rates are also computed for each
+# domain and the number of speakers of videos, where uttid is
+# '{video id}_{utterance index}'.
 
 import argparse
+import os
+import unicodedata
+from collections import defaultdict
+from multiprocessing import Pool
+
 import Levenshtein
-import re
-
-parser = argparse.ArgumentParser(
-    description=__doc__, formatter_class=argparse.RawTextHelpFormatter
-)
-parser.add_argument(
-    "ref", metavar="FILE", type=str, help="path to reference transcription"
-)
-parser.add_argument(
-    "hyp", metavar="FILE", type=str, help="path to hypothesis transcription"
-)
-parser.add_argument(
-    "--verbose", action="store_true", help="print WERs for each utterance"
-)
-
-args = parser.parse_args()
-
-ref = {}
-hyp = {}
-for line in open(args.ref, "r"):
-    key, *text = line.split()
-    ref[key] = text
-
-for line in open(args.hyp, "r"):
-    key, *text = line.split()
-    hyp[key] = text
-
-
-N, S, D, I = 0, 0, 0, 0
-false_sent = 0
-total_sent = len(hyp)
-for key in hyp:
-    if key not in ref:
-        raise Exception(f"no key '{key}' in ref file '{args.ref}'")
-
-    # e = editdistance.eval(ref[key], hyp[key])
-    ret = Levenshtein.editops(ref[key], hyp[key])
-    i = sum(1 for x in ret if x[0] == "insert")
-    d = sum(1 for x in ret if x[0] == "delete")
-    s = sum(1 for x in ret if x[0] == "replace")
-    n = len(ref[key])
-
-    if i + d + s > 0:
-        false_sent += 1
-    if args.verbose:
-        print(f"{key} {(s+d+i)/n*100:5.2f} {n} {s} {d} {i}")
-
-    N += n
-    S += s
-    D += d
-    I += i
-
-print(f"%WER= {(S+D+I)/N*100:5.2f} [ {S+D+I} / {N}, {I} ins, {D} del, {S} sub ]")
-print(f"%SER= {false_sent/len(hyp)*100:5.2f} [ {false_sent} / {len(hyp)} ]")
-print(f"Scored {len(hyp)} sentences, {len(ref)-len(hyp)} not present in hyp.")
+
+UNIT_NAMES = {"word": "WER", "char": "CER", "jamo": "JER"}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "ref", metavar="FILE", type=str, help="path to reference transcription"
+    )
+    parser.add_argument(
+        "hyp", metavar="FILE", type=str, help="path to hypothesis transcription"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="print WERs for each utterance"
+    )
+    parser.add_argument(
+        "--unit",
+        choices=list(UNIT_NAMES),
+        default="word",
+        help="unit of tokens to compare. spaces are ignored for char and jamo",
+    )
+    parser.add_argument(
+        "--list",
+        type=str,
+        default=None,
+        help="path to data/list.txt to break down WER by domain and "
+        "the number of speakers",
+    )
+    parser.add_argument(
+        "--nj",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="the number of processes to score utterances",
+    )
+    return parser
+
+
+def read_text(path):
+    # returns {uttid: text}. text is split in scoring processes
+    text = {}
+    for line in open(path, "r"):
+        w = line.split(maxsplit=1)
+        if len(w) > 0:
+            text[w[0]] = w[1] if len(w) > 1 else ""
+    return text
+
+
+def tokenize(text, unit):
+    if unit == "word":
+        return text.split()
+    # same as split_char.py, spaces are removed
+    chars = "".join(text.split())
+    if unit == "jamo":
+        # Hangul syllables are decomposed into conjoining jamo
+        return unicodedata.normalize("NFD", chars)
+    return chars
+
+
+def score(job):
+    # returns (the number of ref tokens, sub, del, ins) of an utterance
+    ref, hyp, unit = job
+    ref, hyp = tokenize(ref, unit), tokenize(hyp, unit)
+    s, d, i = 0, 0, 0
+    for op, _, _ in Levenshtein.editops(ref, hyp):
+        if op == "replace":
+            s += 1
+        elif op == "delete":
+            d += 1
+        else:
+            i += 1
+    return len(ref), s, d, i
+
+
+def read_video_info(path):
+    # returns {video id: (domain, the number of speakers)}
+    info = {}
+    for line in open(path, "r"):
+        w = line.split()
+        if len(w) >= 3 and w[0][0] != "#":
+            info[w[0]] = (w[1], w[2])
+    return info
+
+
+def error_rate(name, counts):
+    N, S, D, I = counts[:4]
+    E = S + D + I
+    return f"%{name}= {E/max(N, 1)*100:5.2f} [ {E} / {N}, {I} ins, {D} del, {S} sub ]"
+
+
+def main(cmd=None):
+    args = get_parser().parse_args(cmd)
+
+    ref = read_text(args.ref)
+    hyp = read_text(args.hyp)
+    for key in hyp:
+        if key not in ref:
+            raise Exception(f"no key '{key}' in ref file '{args.ref}'")
+
+    jobs = [(ref[key], hyp[key], args.unit) for key in hyp]
+    if args.nj > 1 and len(jobs) > 1000:
+        with Pool(args.nj) as pool:
+            results = pool.map(score, jobs, chunksize=256)
+    else:
+        results = list(map(score, jobs))
+
+    # [N, S, D, I, false_sent, total_sent] of all and of each group
+    total = [0] * 6
+    groups = defaultdict(lambda: [0] * 6)
+    video_info = read_video_info(args.list) if args.list is not None else None
+    for key, (n, s, d, i) in zip(hyp, results):
+        if args.verbose:
+            print(f"{key} {(s+d+i)/max(n, 1)*100:5.2f} {n} {s} {d} {i}")
+        counts = [total]
+        if video_info is not None:
+            # e.g. '-2B1tn-pdoI_000003' -> '-2B1tn-pdoI'
+            domain, speakers = video_info.get(key.rsplit("_", 1)[0], ("?", "?"))
+            counts += [groups[("domain", domain)], groups[("speakers", speakers)]]
+        for c in counts:
+            for k, x in enumerate([n, s, d, i, int(s + d + i > 0), 1]):
+                c[k] += x
+
+    name = UNIT_NAMES[args.unit]
+    false_sent = total[4]
+    print(error_rate(name, total))
+    print(f"%SER= {false_sent/max(len(hyp), 1)*100:5.2f} [ {false_sent} / {len(hyp)} ]")
+    print(f"Scored {len(hyp)} sentences, {len(ref)-len(hyp)} not present in hyp.")
+
+    for kind in ["domain", "speakers"]:
+        # numbers of speakers are sorted as numbers
+        keys = sorted((x for x in groups if x[0] == kind), key=lambda x: x[1].zfill(4))
+        if len(keys) > 0:
+            print(f"# {name} by {kind}")
+        for key in keys:
+            c = groups[key]
+            print(f"{key[1]:<6} {error_rate(name, c)} {c[4]} / {c[5]} sentences")
+
+
+if __name__ == "__main__":
+    main()